@@ -1,15 +1,505 @@
+import hmac
 import os
-from flask import Flask, request, abort, jsonify
-from models import setup_db, db, Movie, Actor
+from datetime import datetime, timezone
+from flask import Flask, Response, current_app, request, abort, stream_with_context
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import selectinload
+from dotenv import load_dotenv
+
+# the settings of .env must be in the environment before this module and the
+# ones imported below (auth, compression, json_provider...) read them on import
+load_dotenv()
+
+from models import setup_db, db, Movie, Actor, actor_movie, change_log, keyset_page, cast_actors, uncast_actors, \
+    bulk_insert, parse_date, parse_int, in_integer_range, stream_query, update_returning, delete_row, search_page, search_words, DELETE
 from flask_cors import CORS
 import logging
 from auth.auth import AuthError, requires_auth
+from cache import LRUCache, cached_response
+from metrics import REGISTRY
+import compression
+import instrumentation
+import json_provider
+from json_provider import json_response
+
+# default and maximum number of rows returned by one page of a listing
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+# maximum number of records of one bulk create request
+MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', 5000))
+# number of rows fetched from the database, and lines sent, at a time by /export
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+# memory of the in-process response cache of the read endpoints, 0 disables it
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# bearer token the metrics scraper sends to GET /metrics, which is off (404) while it is unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', None)
+
+
+def check_metrics_token():
+    '''
+    checks the bearer token of a request to /metrics against METRICS_TOKEN.
+    abort with 404 if no METRICS_TOKEN is configured, 401 if the token is missing or wrong.
+    '''
+    expected = current_app.config.get('METRICS_TOKEN')
+    if not expected:
+        abort(404)
+
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), expected.encode()):
+        abort(401)
+
+
+def get_page_args():
+    '''
+    reads the limit and cursor query parameters of a listing.
+    limit defaults to PAGE_SIZE and is capped at MAX_PAGE_SIZE.
+    abort with 400 if either is not an integer that fits an id column or
+    limit is not positive.
+    '''
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+        cursor = request.args.get('cursor', None)
+        if cursor is not None:
+            cursor = int(cursor)
+    except ValueError:
+        abort(400)
+
+    if limit < 1 or not in_integer_range(limit) or (cursor is not None and not in_integer_range(cursor)):
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE), cursor
+
+
+def get_search_arg():
+    '''
+    reads the q query parameter of a listing, i.e. ?q=dune
+    returns None if it is absent.
+    abort with 400 if it holds no word.
+    '''
+    q = request.args.get('q', None)
+    if q is not None and not search_words(q):
+        abort(400)
+    return q
+
+
+def get_filter_args(model):
+    '''
+    reads the filter query parameters of a listing, the keys of model.FILTERS,
+    i.e. ?age_min=18&gender=Female
+    returns the criteria they add to the query.
+    abort with 400 if a value cannot be converted.
+    '''
+    criteria = []
+    for name, (column, compare, convert) in model.FILTERS.items():
+        value = request.args.get(name, None)
+        if value is None:
+            continue
+        try:
+            criteria.append(compare(getattr(model, column), convert(value)))
+        except (ValueError, TypeError, OverflowError):
+            abort(400)
+    return criteria
+
+
+def get_fields_arg(model):
+    '''
+    reads the comma separated fields query parameter, i.e. ?fields=id,title
+    returns None if it is absent, otherwise the requested column names.
+    abort with 400 if a name is not one of model.FIELDS.
+    '''
+    fields = request.args.get('fields', None)
+    if fields is None:
+        return None
+
+    fields = [field for field in fields.split(',') if field]
+    if not fields or any(field not in model.FIELDS for field in fields):
+        abort(400)
+    return fields
+
+
+def get_include_arg(model):
+    '''
+    reads the comma separated include query parameter, i.e. ?include=actors
+    returns the requested relationship names, empty if it is absent.
+    abort with 400 if a name is not one of model.RELATIONS.
+    '''
+    include = [name for name in request.args.get('include', '').split(',') if name]
+    if any(name not in model.RELATIONS for name in include):
+        abort(400)
+    return include
+
+
+def with_relations(query, model, include):
+    '''
+    loads the included relationships of all rows of query with one extra
+    SELECT ... WHERE id IN (...) per relationship.
+    '''
+    return query.options(*[selectinload(getattr(model, name)) for name in include])
+
+
+def list_columns(model, fields):
+    '''
+    runs a column-only query for a listing instead of hydrating ORM objects.
+    the id column is always selected, since it is the pagination cursor.
+    '''
+    columns = ['id'] + [field for field in fields if field != 'id']
+    return db.session.query(*[getattr(model, column) for column in columns])
+
+
+def get_listing(model, label, *criteria):
+    '''
+    reads one page of model rows, honouring the limit, cursor, q, filter,
+    fields and include query parameters. criteria optionally narrow the query.
+    returns the formatted rows and the cursor of the next page. rows are a
+    dictionary of id: label by default, a list of dictionaries with fields or include.
+    search results (?q=) come best match first, always as a list, and
+    their cursor is an offset.
+    '''
+    limit, cursor = get_page_args()
+    q = get_search_arg()
+    criteria += tuple(get_filter_args(model))
+    fields = get_fields_arg(model)
+    include = get_include_arg(model)
+    if q is not None and fields is None and not include:
+        # a dictionary would lose the ranking, its keys are sorted
+        fields = ['id', label]
+    if include:
+        query = with_relations(model.query, model, include)
+    else:
+        query = list_columns(model, fields or [label])
+    if q is None:
+        rows, next_cursor = keyset_page(query.filter(*criteria), model.id, cursor, limit)
+    elif cursor is not None and cursor < 0:
+        abort(400)
+    else:
+        rows, next_cursor = search_page(query.filter(*criteria), model, q, cursor or 0, limit)
+
+    if include:
+        rows = [row.format(fields, include) for row in rows]
+    elif fields is None:
+        rows = {row.id: getattr(row, label) for row in rows}
+    else:
+        rows = [{field: getattr(row, field) for field in fields} for row in rows]
+    return rows, next_cursor
+
+
+def get_resource(model, id):
+    '''
+    reads one row of model by primary key, honouring the fields and include
+    query parameters, and returns it formatted.
+    abort with 404 if there is no such row.
+    '''
+    fields = get_fields_arg(model)
+    include = get_include_arg(model)
+
+    row = with_relations(model.query, model, include).get(id)
+    if row is None:
+        abort(404)
+    return row.format(fields, include)
+
+
+def get_patch_values(validate):
+    '''
+    reads the new values of a PATCH request body, i.e. {"title": "Dune"},
+    checked by validate (validate_movie or validate_actor) like the values of a POST.
+    keys other than the columns are ignored.
+    abort with 400 if the body is not an object or a value is invalid.
+    '''
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+
+    try:
+        return validate(body, partial=True)
+    except (ValueError, TypeError, OverflowError):
+        abort(400)
+
+
+def format_row(model, row, fields=None):
+    '''
+    formats a row returned by a statement like model.format() formats an object.
+    '''
+    return {field: getattr(row, field) for field in fields or model.FIELDS}
+
+
+def get_actor_ids_arg():
+    '''
+    reads the actor ids of a casting request body, i.e. {"actors": [1, 2, 3]}
+    abort with 422 unless it is a non empty list of at most MAX_PAGE_SIZE
+    integers that fit the id column.
+    '''
+    body = request.get_json(silent=True) or {}
+    actor_ids = body.get('actors', None) if isinstance(body, dict) else None
+
+    if (not isinstance(actor_ids, list) or not actor_ids or len(actor_ids) > MAX_PAGE_SIZE or
+            any(type(actor_id) is not int or not in_integer_range(actor_id) for actor_id in actor_ids)):
+        abort(422)
+    return actor_ids
+
+
+def get_string(body, key, column):
+    '''
+    returns the value of key in a request body, None if it is absent, after
+    checking it is a string that fits column.
+    raise ValueError if it is not a string or is too long.
+    '''
+    value = body.get(key, None)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError('%s must be a string' % key)
+    if len(value) > column.type.length:
+        raise ValueError('%s is longer than %d characters' % (key, column.type.length))
+    return value
+
+
+def validate_movie(body, partial=False):
+    '''
+    checks a movie of a request body with the rules of POST /movies: no empty
+    keys, a title (a string of at most 255 characters) and an optional release_date.
+    partial (PATCH) checks and returns only the columns present in body.
+    returns the column values, raise ValueError if the movie is invalid.
+    '''
+    if not isinstance(body, dict):
+        raise ValueError('a movie must be an object')
+    if '' in body:
+        raise ValueError('empty key')
+    if (not partial or 'title' in body) and not body.get('title', None):
+        raise ValueError('title is required')
+
+    values = {
+        'title': get_string(body, 'title', Movie.__table__.c.title),
+        'release_date': parse_date(body.get('release_date', None))
+    }
+    return {key: value for key, value in values.items() if not partial or key in body}
+
+
+def validate_actor(body, partial=False):
+    '''
+    checks an actor of a request body with the rules of POST /actors: no empty
+    keys, a name and an optional age and gender (strings of at most 255 and 25
+    characters).
+    partial (PATCH) checks and returns only the columns present in body.
+    returns the column values, raise ValueError if the actor is invalid.
+    '''
+    if not isinstance(body, dict):
+        raise ValueError('an actor must be an object')
+    if '' in body:
+        raise ValueError('empty key')
+    if (not partial or 'name' in body) and not body.get('name', None):
+        raise ValueError('name is required')
+
+    values = {
+        'name': get_string(body, 'name', Actor.__table__.c.name),
+        'age': parse_int(body.get('age', None)),
+        'gender': get_string(body, 'gender', Actor.__table__.c.gender)
+    }
+    return {key: value for key, value in values.items() if not partial or key in body}
+
+
+def create_bulk(model, validate):
+    '''
+    creates the list of records of a bulk request body. every record is
+    validated on its own; the valid ones are inserted together in one
+    transaction and the invalid ones are reported.
+    abort with 422 unless the body is a list, 413 if it holds more than MAX_BULK_SIZE records.
+    returns the report: one result per record, with its new id or its error.
+    '''
+    body = request.get_json(silent=True)
+    if not isinstance(body, list):
+        abort(422)
+    if len(body) > MAX_BULK_SIZE:
+        abort(413)
+
+    results = []
+    rows = []
+    for index, record in enumerate(body):
+        try:
+            rows.append(validate(record))
+            results.append({'index': index})
+        except (ValueError, TypeError, OverflowError) as e:
+            results.append({'index': index, 'error': str(e) or 'invalid value'})
+
+    try:
+        ids = iter(bulk_insert(model, rows))
+    except SQLAlchemyError:
+        db.session.rollback()
+        logging.exception('An exception occurred while bulk inserting')
+        abort(422)
+    finally:
+        db.session.close()
+
+    for result in results:
+        if 'error' not in result:
+            result['id'] = next(ids)
+    return {
+        'success': True,
+        'created': len(rows),
+        'results': results
+    }
+
+
+def get_id_range_args():
+    '''
+    reads the optional min_id and max_id query parameters of an export.
+    abort with 400 if either is not an integer.
+    '''
+    try:
+        return [int(request.args[name]) if name in request.args else None
+                for name in ('min_id', 'max_id')]
+    except ValueError:
+        abort(400)
+
+
+def get_updated_since_arg():
+    '''
+    reads the optional updated_since query parameter of an export, an ISO 8601
+    timestamp such as the updated_at of a row, UTC unless it has an offset.
+    abort with 400 if it is not a timestamp.
+    '''
+    value = request.args.get('updated_since', None)
+    if value is None:
+        return None
+    try:
+        updated_since = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+    if updated_since.tzinfo is not None:
+        updated_since = updated_since.astimezone(timezone.utc).replace(tzinfo=None)
+    return updated_since
+
+
+def export_lines(min_id=None, max_id=None, updated_since=None):
+    '''
+    yields the catalog as NDJSON, every movie, then every actor, then every
+    cast link, one {"type": ..., ...} object per line. Rows are read through
+    server side cursors and sent in chunks of EXPORT_BATCH_SIZE lines, so
+    memory stays flat whatever the size of the tables.
+    min_id and max_id restrict movies and actors by id, and links by movie id.
+    updated_since restricts movies and actors to those inserted or updated
+    since, and links to the casts changed since (by their change_log entries).
+    '''
+    def in_range(column):
+        return [criterion for criterion in (
+            column >= min_id if min_id is not None else None,
+            column <= max_id if max_id is not None else None) if criterion is not None]
+
+    def updated(model):
+        return [model.updated_at >= updated_since] if updated_since is not None else []
+
+    cast_changed = []
+    if updated_since is not None:
+        cast_changed.append(actor_movie.c.movie_id.in_(
+            db.select([change_log.c.row_id]).where(change_log.c.table_name == actor_movie.name)
+            .where(change_log.c.changed_at >= updated_since)))
+
+    sources = [
+        ('movie', db.session.query(*[getattr(Movie, field) for field in Movie.FIELDS])
+            .filter(*in_range(Movie.id), *updated(Movie)).order_by(Movie.id)),
+        ('actor', db.session.query(*[getattr(Actor, field) for field in Actor.FIELDS])
+            .filter(*in_range(Actor.id), *updated(Actor)).order_by(Actor.id)),
+        ('cast', db.session.query(actor_movie.c.movie_id, actor_movie.c.actor_id)
+            .filter(*in_range(actor_movie.c.movie_id), *cast_changed)
+            .order_by(actor_movie.c.movie_id, actor_movie.c.actor_id))
+    ]
+
+    dumps = current_app.json_provider.dumps
+    lines = []
+    for kind, query in sources:
+        for row in stream_query(query, EXPORT_BATCH_SIZE):
+            record = row._asdict()
+            record['type'] = kind
+            lines.append(dumps(record) + b'\n')
+            if len(lines) == EXPORT_BATCH_SIZE:
+                yield b''.join(lines)
+                lines = []
+    if lines:
+        yield b''.join(lines)
+
+
+def get_since_arg():
+    '''
+    reads the since query parameter of the change feed, the next_since of a
+    previous page. it defaults to 0, the start of the feed.
+    abort with 400 if it is not an integer or is negative.
+    '''
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        abort(400)
+
+    if since < 0:
+        abort(400)
+    return since
+
+
+# type of the change feed entries of each table, as in /export
+CHANGE_TYPES = {Movie.__tablename__: 'movie', Actor.__tablename__: 'actor', actor_movie.name: 'cast'}
+
+
+def get_changes(since, limit):
+    '''
+    reads the entries of change_log after the cursor since, oldest first,
+    limit entries at most. only the latest entry of each row is returned,
+    with the current values of the row (the actor ids of the cast of a
+    movie) as data, None for deletes and rows deleted since.
+    returns the changes, the cursor of the last entry read and whether more follow.
+    '''
+    entries = db.session.execute(change_log.select().where(change_log.c.id > since)
+                                 .order_by(change_log.c.id).limit(limit + 1)).fetchall()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    next_since = entries[-1].id if entries else since
+
+    latest = {}
+    for entry in entries:
+        latest.pop((entry.table_name, entry.row_id), None)
+        latest[(entry.table_name, entry.row_id)] = entry
+    ids = {}
+    for (name, row_id), entry in latest.items():
+        if entry.operation != DELETE:
+            ids.setdefault(name, []).append(row_id)
+
+    # one SELECT ... WHERE id IN (...) per table
+    data = {}
+    for model in (Movie, Actor):
+        if model.__tablename__ in ids:
+            rows = db.session.query(*[getattr(model, field) for field in model.FIELDS]) \
+                .filter(model.id.in_(ids[model.__tablename__]))
+            data.update(((model.__tablename__, row.id), format_row(model, row)) for row in rows)
+    if actor_movie.name in ids:
+        movie_ids = ids[actor_movie.name]
+        # the cast of a deleted movie has no data either
+        data.update(((actor_movie.name, movie_id), {'actors': []})
+                    for movie_id, in db.session.query(Movie.id).filter(Movie.id.in_(movie_ids)))
+        links = db.session.query(actor_movie.c.movie_id, actor_movie.c.actor_id) \
+            .filter(actor_movie.c.movie_id.in_(movie_ids)) \
+            .order_by(actor_movie.c.movie_id, actor_movie.c.actor_id)
+        for movie_id, actor_id in links:
+            data[(actor_movie.name, movie_id)]['actors'].append(actor_id)
+
+    changes = [{
+        'cursor': entry.id,
+        'type': CHANGE_TYPES[entry.table_name],
+        'id': entry.row_id,
+        'operation': entry.operation,
+        'changed_at': entry.changed_at,
+        'data': data.get(key, None)
+    } for key, entry in latest.items()]
+    return changes, next_since, has_more
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.config['RESPONSE_CACHE'] = LRUCache(RESPONSE_CACHE_MAX_BYTES) if RESPONSE_CACHE_MAX_BYTES else None
+    app.config['METRICS_TOKEN'] = METRICS_TOKEN
+    if test_config is not None:
+        app.config.update(test_config)
     setup_db(app)
+    instrumentation.init_app(app)
+    json_provider.init_app(app)
+    compression.init_app(app)
     CORS(app)
 
     @app.route('/')
@@ -17,61 +507,163 @@ def create_app(test_config=None):
         first_movie = Movie.query.first()
         return 'Hola Capstone! The first movie in the DB is: ' + first_movie.title
 
+    @app.route('/metrics')
+    def get_metrics():
+        # Prometheus text format, metrics of this worker process only
+        check_metrics_token()
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
     @app.route('/movies')
     @requires_auth('view:actors')
+    @cached_response(['movie'], related=['actor_movie', 'actor'])
     def get_movies(jwt):
-        movies = Movie.query.all()
+        movies, next_cursor = get_listing(Movie, 'title')
 
         if len(movies) == 0:
             abort(404)
 
-        movies_dict = {movie.id: movie.title for movie in movies}
-
-        return jsonify({
-            'movies': movies_dict
+        return json_response({
+            'movies': movies,
+            'next_cursor': next_cursor
         })
 
     @app.route('/actors')
     @requires_auth('view:movies')
+    @cached_response(['actor'], related=['actor_movie', 'movie'])
     def get_actors(jwt):
-        actors = Actor.query.all()
+        actors, next_cursor = get_listing(Actor, 'name')
 
         if len(actors) == 0:
             abort(404)
 
-        actors_dict = {actor.id: actor.name for actor in actors}
+        return json_response({
+            'actors': actors,
+            'next_cursor': next_cursor
+        })
 
-        return jsonify({
-            'actors': actors_dict
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth('view:movies')
+    @cached_response(['movie'], related=['actor_movie', 'actor'])
+    def get_movie(jwt, movie_id):
+        return json_response({
+            'success': True,
+            'movie': get_resource(Movie, movie_id)
         })
 
-    @app.route('/movies', methods=['POST'])
-    @requires_auth('add:movies')
-    def create_movie(jwt):
-        body = request.get_json()
+    @app.route('/actors/<int:actor_id>')
+    @requires_auth('view:actors')
+    @cached_response(['actor'], related=['actor_movie', 'movie'])
+    def get_actor(jwt, actor_id):
+        return json_response({
+            'success': True,
+            'actor': get_resource(Actor, actor_id)
+        })
+
+    @app.route('/movies/<int:movie_id>/actors')
+    @requires_auth('view:actors')
+    @cached_response(['actor', 'actor_movie'], related=['movie'])
+    def get_movie_actors(jwt, movie_id):
+        cast = db.session.query(actor_movie.c.actor_id).filter(actor_movie.c.movie_id == movie_id)
+        actors, next_cursor = get_listing(Actor, 'name', Actor.id.in_(cast))
+
+        if len(actors) == 0 and not Movie.exists(movie_id):
+            abort(404)
+
+        return json_response({
+            'actors': actors,
+            'next_cursor': next_cursor
+        })
 
-        for value in body:
-            if value == "":
-                abort(422)
+    @app.route('/actors/<int:actor_id>/movies')
+    @requires_auth('view:movies')
+    @cached_response(['movie', 'actor_movie'], related=['actor'])
+    def get_actor_movies(jwt, actor_id):
+        roles = db.session.query(actor_movie.c.movie_id).filter(actor_movie.c.actor_id == actor_id)
+        movies, next_cursor = get_listing(Movie, 'title', Movie.id.in_(roles))
 
-        new_movie_title = body.get('title', None)
-        new_movie_release_date = body.get('release_date', None)
+        if len(movies) == 0 and not Actor.exists(actor_id):
+            abort(404)
 
-        if not new_movie_title:
+        return json_response({
+            'movies': movies,
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @requires_auth('modify:movies')
+    def cast_movie_actors(jwt, movie_id):
+        actor_ids = get_actor_ids_arg()
+
+        try:
+            added = cast_actors(movie_id, actor_ids)
+        except IntegrityError:
+            # unknown movie or actor ids violate the actor_movie foreign keys
+            db.session.rollback()
+            if not Movie.exists(movie_id):
+                abort(404)
             abort(422)
+        finally:
+            db.session.close()
+
+        return json_response({
+            'success': True,
+            'movie_id': movie_id,
+            'added': added
+        })
 
+    @app.route('/movies/<int:movie_id>/actors', methods=['DELETE'])
+    @requires_auth('modify:movies')
+    def uncast_movie_actors(jwt, movie_id):
+        actor_ids = get_actor_ids_arg()
+        removed = uncast_actors(movie_id, actor_ids)
+
+        if removed == 0 and not Movie.exists(movie_id):
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'movie_id': movie_id,
+            'removed': removed
+        })
+
+    @app.route('/export')
+    @requires_auth(['view:movies', 'view:actors'])
+    def export_catalog(jwt):
+        min_id, max_id = get_id_range_args()
+        updated_since = get_updated_since_arg()
+
+        return Response(stream_with_context(export_lines(min_id, max_id, updated_since)),
+                        mimetype='application/x-ndjson')
+
+    @app.route('/changes')
+    @requires_auth(['view:movies', 'view:actors'])
+    @cached_response(['change_log'])
+    def get_change_feed(jwt):
+        since = get_since_arg()
+        limit, _ = get_page_args()
+        changes, next_since, has_more = get_changes(since, limit)
+
+        return json_response({
+            'success': True,
+            'changes': changes,
+            'next_since': next_since,
+            'has_more': has_more
+        })
+
+    @app.route('/movies', methods=['POST'])
+    @requires_auth('add:movies')
+    def create_movie(jwt):
         try:
-            new_movie = Movie(title=new_movie_title,
-                              release_date=new_movie_release_date)
+            new_movie = Movie(**validate_movie(request.get_json()))
 
             new_movie.insert()
-            return jsonify({
+            return json_response({
                 'success': True
             })
 
-        except ValueError as e:
+        except (ValueError, TypeError, OverflowError) as e:
             db.session.rollback()
-            print(e)
+            logging.info('Invalid movie: %s', e)
             abort(422)
         finally:
             db.session.close()
@@ -79,109 +671,83 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['POST'])
     @requires_auth('add:actors')
     def create_actor(jwt):
-        body = request.get_json()
-
-        for value in body:
-            if value == "":
-                abort(422)
-
-        new_actor_name = body.get('name', None)
-        new_actor_age = body.get('age', None)
-        new_actor_gender = body.get('gender', None)
-
-        if not new_actor_name:
-            abort(422)
-
         try:
-            new_actor = Actor(name=new_actor_name,
-                              age=new_actor_age,
-                              gender=new_actor_gender)
+            new_actor = Actor(**validate_actor(request.get_json()))
 
             new_actor.insert()
-            return jsonify({
+            return json_response({
                 'success': True
             })
 
-        except ValueError as e:
+        except (ValueError, TypeError, OverflowError) as e:
             db.session.rollback()
-            print(e)
+            logging.info('Invalid actor: %s', e)
             abort(422)
         finally:
             db.session.close()
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('add:movies')
+    def create_movies(jwt):
+        return json_response(create_bulk(Movie, validate_movie))
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('add:actors')
+    def create_actors(jwt):
+        return json_response(create_bulk(Actor, validate_actor))
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('modify:movies')
     def patch_movie(jwt, movie_id):
-        body = request.get_json()
+        fields = get_fields_arg(Movie)
+        values = get_patch_values(validate_movie)
 
         try:
-            movie_to_patch = Movie.query.filter(Movie.id == movie_id).one_or_none()
-            if movie_to_patch is None:
-                abort(404)
-
-            if 'title' in body:
-                movie_to_patch.title = str(body.get('title'))
-
-            if 'release_date' in body:
-                movie_to_patch.release_date = body.get('release_date')
-
-            movie_to_patch.update()
-            updated_movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-
-            return jsonify({"success": True,
-                            "movie": [updated_movie.format()]})
-
-        except Exception as E:
+            updated_movie = update_returning(Movie, movie_id, values)
+        except SQLAlchemyError:
+            db.session.rollback()
             logging.exception('An exception occurred while updating movie')
             abort(400)
 
+        if updated_movie is None:
+            abort(404)
+
+        return json_response({"success": True,
+                        "movie": [format_row(Movie, updated_movie, fields)]})
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('modify:actors')
     def patch_actor(jwt, actor_id):
-        body = request.get_json()
+        fields = get_fields_arg(Actor)
+        values = get_patch_values(validate_actor)
 
         try:
-            actor_to_patch = Actor.query.filter(Actor.id == actor_id).one_or_none()
-            if actor_to_patch is None:
-                abort(404)
-
-            if 'name' in body:
-                actor_to_patch.name = str(body.get('name'))
-
-            if 'age' in body:
-                actor_to_patch.age = body.get('age')
-
-            if 'gender' in body:
-                actor_to_patch.gender = body.get('gender')
-
-            actor_to_patch.update()
-            updated_actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-
-            return jsonify({"success": True,
-                            "actor": [updated_actor.format()]})
-
-        except Exception as E:
+            updated_actor = update_returning(Actor, actor_id, values)
+        except SQLAlchemyError:
+            db.session.rollback()
             logging.exception('An exception occurred while updating actor')
             abort(400)
 
+        if updated_actor is None:
+            abort(404)
+
+        return json_response({"success": True,
+                        "actor": [format_row(Actor, updated_actor, fields)]})
+
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(jwt, movie_id):
-        selection = Movie.query.filter(Movie.id == movie_id).all()
-        if len(selection) == 0:
+        if not delete_row(Movie, movie_id):
             abort(404)
-        selection[0].delete()
-        return jsonify({"success": True,
+        return json_response({"success": True,
                         "deleted": movie_id})
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(jwt, actor_id):
-        selection = Actor.query.filter(Actor.id == actor_id).all()
-        if len(selection) == 0:
+        if not delete_row(Actor, actor_id):
             abort(404)
-        selection[0].delete()
-        return jsonify({"success": True,
+        return json_response({"success": True,
                         "deleted": actor_id})
 
     # Error Handling
@@ -192,7 +758,7 @@ def create_app(test_config=None):
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 422,
             "message": "unprocessable"
@@ -200,7 +766,7 @@ def create_app(test_config=None):
 
     @app.errorhandler(405)
     def method_not_allowed(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 405,
             "message": "Method Not Allowed"
@@ -208,7 +774,7 @@ def create_app(test_config=None):
 
     @app.errorhandler(401)
     def unauthorized(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 401,
             "message": "unauthorized"
@@ -216,15 +782,23 @@ def create_app(test_config=None):
 
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 400,
             "message": "Bad Request"
         }), 400
 
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return json_response({
+            "success": False,
+            "error": 413,
+            "message": "Payload Too Large"
+        }), 413
+
     @app.errorhandler(404)
     def not_found(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 404,
             "message": "resource not found"
@@ -232,22 +806,28 @@ def create_app(test_config=None):
 
     @app.errorhandler(403)
     def permissions_not_found(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 403,
             "message": "Permission not found"
         }), 403
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return json_response({
+            "success": False,
+            "error": 503,
+            "message": "Service Unavailable"
+        }), 503
+
     @app.errorhandler(AuthError)
     def autherror_handler(ex):
-        response = jsonify(ex.error)
+        response = json_response(ex.error)
         response.status_code = ex.status_code
         return response
 
     return app
 
 
-app = create_app()
-
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
@@ -1,14 +1,31 @@
 import json
+import hashlib
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 import logging
 import os
+import threading
+import time
+
+from instrumentation import timed
+from metrics import Counter, Gauge
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
+# where the signing keys are published, the Auth0 tenant unless pointed at a stand-in
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+# seconds a downloaded key set is considered fresh
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+# minimum seconds between two refresh attempts (unknown kid or failing endpoint)
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# maximum number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
 
 
 class AuthError(Exception):
@@ -21,6 +38,7 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+@timed('auth_header')
 def get_token_auth_header():
     """
     Obtains the Access Token from the Authorization Header
@@ -61,14 +79,31 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+def compile_permissions(permissions):
+    """
+        @INPUTS
+            permissions: string permission (i.e. 'post:drink') or a collection of them
+
+        return the permissions as a frozenset, so they can be checked with set operations.
+    """
+    if isinstance(permissions, str):
+        return frozenset([permissions])
+    return frozenset(permissions)
+
+
+@timed('check_permissions')
+def check_permissions(permission, payload, any_of=frozenset(), granted=None):
     """
         @INPUTS
-            permission: string permission (i.e. 'post:drink')
+            permission: string permission (i.e. 'post:drink') or a collection of
+                permissions that are all required
             payload: decoded jwt payload
+            any_of: collection of permissions of which at least one is required
+            granted: frozenset of the payload permissions, built from payload if omitted
 
         raise an AuthError if permissions are not included in the payload.
-        raise an AuthError if the requested permission string is not in the payload permissions array.
+        raise an AuthError if a required permission is not in the payload permissions array,
+        or if none of the any_of permissions is.
         return true otherwise.
     """
     if 'permissions' not in payload:
@@ -77,7 +112,12 @@ def check_permissions(permission, payload):
                             'description': 'Permissions not included in JWT.'
                         }, 400)
 
-    if permission not in payload['permissions']:
+    if granted is None:
+        granted = frozenset(payload['permissions'])
+    if not isinstance(permission, frozenset):
+        permission = compile_permissions(permission)
+
+    if not permission <= granted or (any_of and granted.isdisjoint(any_of)):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -85,40 +125,151 @@ def check_permissions(permission, payload):
     return True
 
 
+@timed('jwks_fetch')
+def fetch_jwks():
+    """
+    Downloads the JSON Web Key Set published by the Auth0 tenant.
+
+    !!NOTE urlopen has a common certificate error described here:
+    https://stackoverflow.com/questions/50236117/
+    scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
+    """
+    jsonurl = urlopen(JWKS_URL, timeout=JWKS_FETCH_TIMEOUT)
+    return json.loads(jsonurl.read())
+
+
+class JWKSCache:
+    """
+    JWKSCache
+    Process-wide cache of the signing keys, indexed by key id (kid).
+
+    - keys are served from memory while younger than ttl.
+    - once stale, the stale keys keep being served while a single background
+      thread downloads a new set (stale-while-revalidate). If the download
+      fails the stale keys stay in use.
+    - a token with an unknown kid forces a synchronous refresh, at most once
+      every min_refresh_interval seconds.
+    - only one thread downloads at a time; threads waiting on a refresh reuse
+      its result instead of fetching again.
+
+    fetcher is any callable returning the parsed jwks.json document, so tests
+    can inject a stand-in instead of reaching Auth0.
+    """
+    def __init__(self, fetcher=None, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 clock=time.monotonic):
+        self.fetcher = fetcher or fetch_jwks
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._attempts = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        """
+            @INPUTS
+                kid: key id taken from the token header
+
+            return the rsa key matching kid, or None if the tenant does not publish it.
+        """
+        if not self._keys:
+            self.refresh()
+        elif self.clock() - self._fetched_at >= self.ttl:
+            self._refresh_in_background()
+
+        if kid not in self._keys and self._may_refresh():
+            self.refresh()
+
+        return self._keys.get(kid)
+
+    def refresh(self):
+        """
+        Downloads the key set, unless another thread already did so while this
+        one was waiting for the lock.
+        raise an AuthError if the download fails and there are no keys to fall back to.
+        """
+        seen = self._attempts
+        with self._lock:
+            if self._attempts != seen:
+                return
+            self._fetch()
+
+        if not self._keys:
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch the signing keys.'
+            }, 503)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def _fetch(self):
+        self._last_attempt = self.clock()
+        try:
+            jwks = self.fetcher()
+        except Exception:
+            logging.exception('An exception occurred while fetching the JWKS')
+            return
+        finally:
+            self._attempts += 1
+
+        self._keys = {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            } for key in jwks['keys']
+        }
+        self._fetched_at = self._last_attempt
+
+    def _may_refresh(self):
+        return (self._last_attempt is None or
+                self.clock() - self._last_attempt >= self.min_refresh_interval)
+
+    def _refresh_in_background(self):
+        if self._lock.locked() or not self._may_refresh():
+            return
+
+        def refresh_quietly():
+            try:
+                self.refresh()
+            except AuthError:
+                pass
+
+        threading.Thread(target=refresh_quietly, daemon=True).start()
+
+
+jwks_cache = JWKSCache()
+
+
+@timed('jwt_verify')
 def verify_decode_jwt(token):
     """
         @INPUTS
             token: a json web token (string)
 
         check it is Auth0 token with key id (kid)
-        Verify the token using Auth0 /.well-known/jwks.json
+        Verify the token using the cached Auth0 /.well-known/jwks.json keys
         Decode the payload from the token
         Validate the claims.
         Return the decoded payload.
-
-        !!NOTE urlopen has a common certificate error described here:
-        https://stackoverflow.com/questions/50236117/
-        scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
     """
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -153,29 +304,131 @@ def verify_decode_jwt(token):
             }, 400)
 
 
-def requires_auth(permission=''):
+class TokenCache:
+    """
+    TokenCache
+    Bounded LRU cache of verified token payloads.
+
+    Entries are keyed by the sha256 of the token (the raw bearer token is
+    never kept) and expire at the token's exp claim, so a cached payload is
+    never used longer than jwt.decode would have accepted the token.
+    Tokens without an exp claim are not cached.
+    Each entry keeps the payload together with its permissions as a frozenset
+    (None when the claim is missing), so they are built once per token.
+    """
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        """
+        return the cached (payload, permissions) pair for token, or None on a miss.
+        """
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1:]
+
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload, permissions=None):
+        exp = payload.get('exp')
+        if not self.maxsize or not isinstance(exp, (int, float)):
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (exp, payload, permissions)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+token_cache = TokenCache()
+
+Counter('auth_token_cache_hits_total', 'Bearer tokens whose verified payload came from the token cache',
+        lambda: token_cache.hits)
+Counter('auth_token_cache_misses_total', 'Bearer tokens that had to be verified', lambda: token_cache.misses)
+Counter('auth_token_cache_evictions_total', 'Verified tokens dropped to keep the cache within TOKEN_CACHE_SIZE',
+        lambda: token_cache.evictions)
+Gauge('auth_token_cache_size', 'Verified tokens in the token cache', lambda: len(token_cache._entries))
+
+
+def get_verified_payload(token):
+    """
+        @INPUTS
+            token: a json web token (string)
+
+        return the (payload, permissions) pair from the verified-token cache,
+        verifying and caching the token with verify_decode_jwt on a miss.
+        permissions is the frozenset of the payload permissions, or None if the
+        payload has no permissions claim.
+    """
+    entry = token_cache.get(token)
+    if entry is None:
+        payload = verify_decode_jwt(token)
+        permissions = None
+        if isinstance(payload.get('permissions'), list):
+            permissions = frozenset(payload['permissions'])
+        token_cache.put(token, payload, permissions)
+        entry = (payload, permissions)
+    return entry
+
+
+def requires_auth(permission='', any_of=()):
     """
     decorator method
         @INPUTS
-            permission: string permission (i.e. 'post:drink')
+            permission: string permission (i.e. 'post:drink') or a collection of
+                permissions that are all required
+            any_of: optional collection of permissions of which at least one is required
 
         Use the get_token_auth_header method to get the token.
-        Use the verify_decode_jwt method to decode the jwt.
+        Use the get_verified_payload method to decode the jwt (cached per token).
         Use the check_permissions method validate claims and check the requested permission.
         Return the decorator which passes the decoded payload to the decorated method.
     """
+    required = compile_permissions(permission)
+    any_of = compile_permissions(any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             try:
                 token = get_token_auth_header()
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
+                payload, granted = get_verified_payload(token)
+                check_permissions(required, payload, any_of, granted)
 
             except Exception as e:
-                # logging.exception('An exception occurred while in wrapper internal function')
-                # print('HERE: '+str(e.status_code))
-                # abort(401)
                 abort(e.status_code)
 
             return f(payload, *args, **kwargs)
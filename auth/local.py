@@ -0,0 +1,116 @@
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwt
+
+'''
+Stand-in for the Auth0 tenant, for load tests, benchmarks and tests that run
+without network access: an RSA key pair generated in memory signs tokens the
+way Auth0 does, and its public half is published as a JWKS, either directly
+(LocalIssuer.jwks, i.e. as the fetcher of a JWKSCache) or over HTTP
+(serve_jwks, with JWKS_URL pointing at it).
+'''
+
+# permissions of the roles of the README, as Auth0 puts them in the tokens
+ROLES = {
+    'assistant': ['view:actors', 'view:movies'],
+    'director': ['add:actors', 'delete:actors', 'modify:actors', 'modify:movies',
+                 'view:actors', 'view:movies'],
+    'producer': ['add:actors', 'add:movies', 'delete:actors', 'delete:movies',
+                 'modify:actors', 'modify:movies', 'view:actors', 'view:movies']
+}
+
+
+def b64url_uint(value):
+    return base64.urlsafe_b64encode(value.to_bytes((value.bit_length() + 7) // 8, 'big')).rstrip(b'=').decode()
+
+
+class LocalIssuer:
+    """
+    LocalIssuer
+        @INPUTS
+            domain: the AUTH0_DOMAIN the tokens are issued for
+            audience: the API_AUDIENCE of the tokens
+            kid: key id of the signing key
+            bits: size of the generated RSA key (2048 takes a few seconds in pure python)
+    """
+    def __init__(self, domain, audience, kid='local', bits=2048):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        public_key, private_key = rsa.newkeys(bits)
+        self.public_key = public_key
+        self.private_pem = private_key.save_pkcs1().decode()
+
+    def jwks(self):
+        """the JSON Web Key Set with the public key, as served by /.well-known/jwks.json"""
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': b64url_uint(self.public_key.n),
+            'e': b64url_uint(self.public_key.e)
+        }]}
+
+    def token(self, permissions, expires_in=3600, subject='local|user'):
+        """
+            @INPUTS
+                permissions: list of permissions, or the name of one of ROLES
+                expires_in: seconds until the token expires
+                subject: the sub claim
+        """
+        if isinstance(permissions, str):
+            permissions = ROLES[permissions]
+        now = int(time.time())
+        claims = {
+            'iss': 'https://%s/' % self.domain,
+            'sub': subject,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256', headers={'kid': self.kid})
+
+
+def serve_jwks(issuer, host='127.0.0.1', port=0, delay=0):
+    """
+        @INPUTS
+            issuer: the LocalIssuer whose keys are served
+            port: 0 picks a free port
+            delay: seconds every response is held back, to stand in for the latency of Auth0
+
+        Serves the JWKS of issuer at http://host:port/.well-known/jwks.json
+        from a daemon thread. Returns the server: server.url is the JWKS url,
+        server.fetches the number of downloads, server.shutdown() stops it.
+    """
+    body = json.dumps(issuer.jwks()).encode()
+
+    class JWKSHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/.well-known/jwks.json':
+                self.send_error(404)
+                return
+            server.fetches += 1
+            if delay:
+                time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), JWKSHandler)
+    server.daemon_threads = True
+    server.fetches = 0
+    server.url = 'http://%s:%d/.well-known/jwks.json' % server.server_address[:2]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
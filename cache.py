@@ -0,0 +1,211 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+from compression import negotiate_encoding
+from metrics import Counter, Gauge
+from models import get_versions
+
+'''
+Read-through response cache and conditional GETs
+
+Cached bodies are keyed by the request path, its query parameters and the
+current versions of the tables the endpoint reads (see models.table_version).
+Every write bumps the versions of the tables it touches in the same
+transaction, so after a write the old entries are simply never looked up
+again and age out of the backend.
+
+The same key, hashed, is the strong ETag of the response: a request whose
+If-None-Match holds it gets a 304 without loading or serializing any row.
+If-None-Match: * is answered with a 304 only once the endpoint has found the
+resource, so a missing one is still a 404.
+
+The backend is app.config['RESPONSE_CACHE']: any object with get(key) and
+set(key, value), such as LRUCache (per process) or SharedCache (shared by
+all workers). None disables the cache.
+'''
+
+
+class CacheBackend:
+    """
+    CacheBackend
+    Interface of a response cache backend. Keys are strings, values bytes.
+    """
+    def get(self, key):
+        """return the value stored under key, or None"""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """
+    LRUCache
+    In-process backend. Evicts the least recently used entries once the
+    values held exceed max_bytes in total.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+def response_cache_stat(name):
+    """
+    returns one of the stats of the LRUCache of the current app, or None
+    outside an app or for other backends (their counts are not this worker's).
+    """
+    try:
+        cache = current_app.config.get('RESPONSE_CACHE')
+    except RuntimeError:
+        return None
+    return cache.stats()[name] if isinstance(cache, LRUCache) else None
+
+
+Counter('response_cache_hits_total', 'Responses served from the in-process response cache',
+        lambda: response_cache_stat('hits'))
+Counter('response_cache_misses_total', 'Cacheable responses not found in the in-process response cache',
+        lambda: response_cache_stat('misses'))
+Counter('response_cache_evictions_total', 'Responses dropped to keep the cache within RESPONSE_CACHE_MAX_BYTES',
+        lambda: response_cache_stat('evictions'))
+Gauge('response_cache_entries', 'Responses in the in-process response cache', lambda: response_cache_stat('entries'))
+Gauge('response_cache_bytes', 'Bytes of the responses in the in-process response cache',
+      lambda: response_cache_stat('bytes'))
+
+
+class SharedCache(CacheBackend):
+    """
+    SharedCache
+    Backend shared by all workers, over any client with get(key) and
+    set(key, value, ex=seconds), i.e. a redis.Redis instance. Entries expire
+    after ttl seconds so stale versions do not accumulate.
+    """
+    def __init__(self, client, ttl=300, prefix='lav_cast_agency:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+
+def held_etag(etag):
+    """
+        @INPUTS
+            etag: the current ETag of the requested resource
+
+        return the ETag of If-None-Match that designates the current version of
+        the resource as this request would receive it, either etag itself or
+        etag suffixed with the encoding the request negotiates (i.e.
+        "<etag>-gzip", see compression.py), or None.
+    """
+    encoding = negotiate_encoding(current_app.config) if 'COMPRESS_ENCODINGS' in current_app.config else None
+    for held in request.if_none_match.as_set():
+        if held == etag or (encoding is not None and held == '%s-%s' % (etag, encoding)):
+            return held
+    return None
+
+
+def not_modified(etag):
+    """return a 304 Not Modified response with etag"""
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def cached_response(tables, related=()):
+    """
+    decorator method
+        @INPUTS
+            tables: names of the tables the endpoint reads
+            related: names of the extra tables read when relations are included (?include=...)
+
+        Answers 304 Not Modified when If-None-Match holds the current ETag,
+        serves the stored body of a previous identical request while the
+        tables are unchanged, and otherwise runs the endpoint and stores its
+        body if it succeeded. Place it below requires_auth so permissions are
+        checked before anything is served.
+    """
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            names = tuple(tables) + (tuple(related) if 'include' in request.args else ())
+            versions = get_versions(names)
+            if versions is None:
+                return f(*args, **kwargs)
+
+            key = '%s?%s|%s' % (request.path,
+                                '&'.join('%s=%s' % item for item in sorted(request.args.items(multi=True))),
+                                ','.join(map(str, versions)))
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            held = held_etag(etag)
+            if held is not None:
+                return not_modified(held)
+            star = request.if_none_match.star_tag
+
+            backend = current_app.config.get('RESPONSE_CACHE')
+            body = backend.get(key) if backend is not None else None
+            if body is not None:
+                if star:
+                    return not_modified(etag)
+                response = current_app.response_class(body, mimetype='application/json')
+                response.set_etag(etag)
+                return response
+
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response.set_etag(etag)
+                if backend is not None:
+                    backend.set(key, response.get_data())
+                if star:
+                    return not_modified(etag)
+            return response
+
+        return wrapper
+    return cached_response_decorator
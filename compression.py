@@ -0,0 +1,178 @@
+import gzip
+import os
+import time
+import zlib
+
+from flask import request
+
+from instrumentation import record
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip is offered without it
+    brotli = None
+
+'''
+Response compression
+
+The responses are compressed with the best of the COMPRESS_ENCODINGS the
+client accepts (Accept-Encoding, honouring q-values):
+- buffered bodies only from COMPRESS_MIN_SIZE bytes on, since compressing a
+  few bytes costs more than it saves.
+- streamed bodies (i.e. /export) chunk by chunk, flushing the compressor
+  after every chunk so the client receives each one as soon as it is sent.
+
+Compressible responses carry Vary: Accept-Encoding whether compressed or not.
+The strong ETag of a compressed body gets the encoding as a suffix
+(i.e. "<etag>-gzip"), as its bytes differ from the identity body;
+cached_response recognises the suffixed ETags in If-None-Match.
+
+The time spent compressing is the compress phase of the request timings.
+Each setting may be overridden in the config of the app.
+'''
+
+# encodings offered, in order of preference; brotli needs the brotli package
+COMPRESS_ENCODINGS = os.environ.get('COMPRESS_ENCODINGS', 'br,gzip')
+# smallest buffered body worth compressing, in bytes
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+# gzip level, 1 (fastest) to 9 (smallest)
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+# brotli quality, 0 (fastest) to 11 (smallest)
+COMPRESS_BROTLI_LEVEL = int(os.environ.get('COMPRESS_BROTLI_LEVEL', 4))
+COMPRESS_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/plain', 'text/html', 'text/csv'}
+
+
+class GzipStream:
+    """
+    GzipStream
+    Incremental gzip compressor: compress(chunk) returns the compressed bytes
+    of chunk, flushed so they can be decompressed on their own, finish() the end
+    of the stream.
+    """
+    def __init__(self, level):
+        # wbits 31: a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliStream:
+    """
+    BrotliStream
+    Incremental brotli compressor, like GzipStream.
+    """
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, chunk):
+        return self._compressor.process(chunk) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def get_encodings(config):
+    '''
+    get_encodings(config)
+        returns the encodings offered, in order of preference, leaving out
+        brotli when it is not installed.
+    '''
+    encodings = [encoding.strip() for encoding in config['COMPRESS_ENCODINGS'].split(',') if encoding.strip()]
+    return [encoding for encoding in encodings if encoding != 'br' or brotli is not None]
+
+
+def negotiate_encoding(config):
+    '''
+    negotiate_encoding(config)
+        returns the encoding a compressible response to the current request
+        gets, or None if the client accepts none of the encodings offered.
+    '''
+    encodings = get_encodings(config)
+    return request.accept_encodings.best_match(encodings) if encodings else None
+
+
+def compress(data, encoding, config):
+    '''
+    compress(data, encoding, config)
+        returns data compressed with encoding (gzip or br).
+    '''
+    start = time.perf_counter()
+    try:
+        if encoding == 'br':
+            return brotli.compress(data, quality=config['COMPRESS_BROTLI_LEVEL'])
+        return gzip.compress(data, compresslevel=config['COMPRESS_LEVEL'])
+    finally:
+        record('compress', time.perf_counter() - start)
+
+
+def compress_stream(chunks, encoding, config):
+    '''
+    compress_stream(chunks, encoding, config)
+        yields the chunks (bytes) compressed with encoding, one compressed
+        chunk per chunk.
+    '''
+    if encoding == 'br':
+        stream = BrotliStream(config['COMPRESS_BROTLI_LEVEL'])
+    else:
+        stream = GzipStream(config['COMPRESS_LEVEL'])
+
+    for chunk in chunks:
+        start = time.perf_counter()
+        data = stream.compress(chunk)
+        record('compress', time.perf_counter() - start)
+        if data:
+            yield data
+    yield stream.finish()
+
+
+def init_app(app):
+    '''
+    init_app(app)
+        compresses the responses of app. Call it after instrumentation.init_app,
+        so the compression of buffered bodies is part of the request timings.
+    '''
+    app.config.setdefault('COMPRESS_ENCODINGS', COMPRESS_ENCODINGS)
+    app.config.setdefault('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    app.config.setdefault('COMPRESS_LEVEL', COMPRESS_LEVEL)
+    app.config.setdefault('COMPRESS_BROTLI_LEVEL', COMPRESS_BROTLI_LEVEL)
+    app.config.setdefault('COMPRESS_MIMETYPES', COMPRESS_MIMETYPES)
+
+    @app.after_request
+    def compress_response(response):
+        config = app.config
+        encodings = get_encodings(config)
+        if not encodings or response.direct_passthrough or 'Content-Encoding' in response.headers:
+            return response
+        if response.status_code == 304:
+            response.vary.add('Accept-Encoding')
+            return response
+        if response.mimetype not in config['COMPRESS_MIMETYPES']:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if response.status_code < 200 or response.status_code in (204, 206):
+            return response
+        encoding = negotiate_encoding(config)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            inner = response.response
+            response.response = compress_stream(response.iter_encoded(), encoding, config)
+            if hasattr(inner, 'close'):
+                response.call_on_close(inner.close)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress(data, encoding, config))
+            etag, weak = response.get_etag()
+            if etag is not None:
+                response.set_etag('%s-%s' % (etag, encoding), weak)
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,30 @@
+import os
+
+'''
+gunicorn settings, read by default from the working directory.
+
+GUNICORN_WORKER_CLASS=gevent (or -k gevent) runs every worker as a gevent
+loop serving up to GUNICORN_WORKER_CONNECTIONS requests at once: the worker
+monkey patches the standard library (so the JWKS download yields) and
+post_worker_init makes psycopg2 wait for the database cooperatively. Requests then queue for
+a database connection (DB_POOL_SIZE + DB_MAX_OVERFLOW per worker) instead of
+for a worker.
+'''
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+# heroku sets WEB_CONCURRENCY from the dyno size
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+
+def post_worker_init(worker):
+    # the class of the worker itself, whichever setting chose it
+    try:
+        from gunicorn.workers.ggevent import GeventWorker
+    except ImportError:  # without gevent no worker can be a gevent one
+        return
+    if isinstance(worker, GeventWorker):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,210 @@
+import csv
+import io
+import itertools
+import json
+import time
+
+from app import validate_movie, validate_actor
+from models import db, Movie, Actor, actor_movie, import_progress, import_key, dialect_insert, insert_rows, \
+    link_actors, log_changes, touch, UPDATE
+
+'''
+Bulk import of movies, actors and casting links.
+
+Files are NDJSON (.ndjson/.jsonl, one object per line) or CSV with a header
+row. Movies and actors may carry an external "id"; casting links reference
+those external ids through "movie_id" and "actor_id", which are resolved to
+the primary keys the import assigned.
+
+Records are read lazily and written in chunks, one transaction per chunk.
+A named import saves its progress and the external ids of every chunk to the
+import_progress and import_key tables in that same transaction, and an
+interrupted import started again with the same name skips what was already
+committed.
+'''
+
+
+def read_records(path):
+    '''
+    read_records(path)
+        yields the records of a NDJSON or CSV file one at a time.
+        empty CSV cells become None.
+    '''
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            for record in csv.DictReader(f):
+                yield {key: value if value != '' else None for key, value in record.items()}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def chunked(records, size):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ImportState:
+    '''
+    ImportState
+        progress of an import: the number of records committed per source
+        table and the mapping of external ids to primary keys. A named import
+        loads them from the database and records each chunk with it.
+    '''
+    def __init__(self, name=None):
+        self.name = name
+        self.data = {}
+        if name is None:
+            return
+        for source, done in db.session.execute(
+                db.select([import_progress.c.source, import_progress.c.done])
+                .where(import_progress.c.name == name)):
+            self.section(source)['done'] = done
+        for source, external_id, id in db.session.execute(
+                db.select([import_key.c.source, import_key.c.external_id, import_key.c.id])
+                .where(import_key.c.name == name)):
+            self.section(source)['ids'][external_id] = id
+
+    def section(self, source):
+        return self.data.setdefault(source, {'done': 0, 'ids': {}})
+
+    def record(self, source, done, ids=None):
+        '''
+        adds the done records and the new ids (external id: primary key) of a
+        chunk of source, and writes them without committing: the chunk's own
+        commit saves them.
+        '''
+        section = self.section(source)
+        section['done'] += done
+        section['ids'].update(ids or {})
+        if self.name is None:
+            return
+
+        if ids:
+            insert = dialect_insert(import_key).values([
+                {'name': self.name, 'source': source, 'external_id': external_id, 'id': id}
+                for external_id, id in ids.items()])
+            db.session.execute(insert.on_conflict_do_update(
+                index_elements=[import_key.c.name, import_key.c.source, import_key.c.external_id],
+                set_={'id': insert.excluded.id}))
+        insert = dialect_insert(import_progress).values(name=self.name, source=source, done=section['done'])
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=[import_progress.c.name, import_progress.c.source],
+            set_={'done': insert.excluded.done}))
+
+
+def import_entities(model, validate, path, state, chunk_size):
+    '''
+    import_entities(model, validate, path, state, chunk_size)
+        inserts the movies or actors of path, chunk by chunk, and records the
+        primary key of every record with an external id.
+        returns the number of imported and skipped records.
+    '''
+    section = state.section(model.__tablename__)
+    records = itertools.islice(read_records(path), section['done'], None)
+    imported = skipped = 0
+
+    for chunk in chunked(records, chunk_size):
+        rows = []
+        external_ids = []
+        for record in chunk:
+            try:
+                rows.append(validate(record))
+                external_ids.append(record.get('id', None))
+            except (ValueError, TypeError, OverflowError):
+                skipped += 1
+
+        ids = insert_rows(model, rows)
+        state.record(model.__tablename__, len(chunk), {
+            str(external_id): new_id for external_id, new_id in zip(external_ids, ids) if external_id is not None})
+        db.session.commit()
+        imported += len(rows)
+
+    return imported, skipped
+
+
+def copy_links(rows):
+    '''
+    copy_links(rows)
+        postgresql only: streams rows into a temporary table with COPY and
+        moves them to actor_movie, skipping links that already exist.
+    '''
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows((row['actor_id'], row['movie_id']) for row in rows)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE import_actor_movie '
+                   '(actor_id integer, movie_id integer) ON COMMIT DROP')
+    cursor.copy_expert('COPY import_actor_movie (actor_id, movie_id) FROM STDIN WITH (FORMAT csv)', buffer)
+    cursor.execute('INSERT INTO actor_movie (actor_id, movie_id) '
+                   'SELECT DISTINCT actor_id, movie_id FROM import_actor_movie '
+                   'ON CONFLICT DO NOTHING')
+    if not cursor.rowcount:
+        return
+    touch(actor_movie.name)
+    log_changes([(actor_movie.name, movie_id, UPDATE) for movie_id in sorted({row['movie_id'] for row in rows})])
+
+
+def import_links(path, state, chunk_size):
+    '''
+    import_links(path, state, chunk_size)
+        links actors to movies, chunk by chunk. external ids are resolved
+        through the ids recorded while importing movies and actors.
+        returns the number of imported and skipped (unresolved) records.
+    '''
+    section = state.section(actor_movie.name)
+    movie_ids = state.section(Movie.__tablename__)['ids']
+    actor_ids = state.section(Actor.__tablename__)['ids']
+    records = itertools.islice(read_records(path), section['done'], None)
+    imported = skipped = 0
+
+    for chunk in chunked(records, chunk_size):
+        rows = []
+        for record in chunk:
+            movie_id = movie_ids.get(str(record.get('movie_id', None)), None)
+            actor_id = actor_ids.get(str(record.get('actor_id', None)), None)
+            if movie_id is None or actor_id is None:
+                skipped += 1
+            else:
+                rows.append({'movie_id': movie_id, 'actor_id': actor_id})
+
+        if rows and db.engine.dialect.name == 'postgresql':
+            copy_links(rows)
+        elif rows:
+            link_actors(rows)
+        state.record(actor_movie.name, len(chunk))
+        db.session.commit()
+        imported += len(rows)
+
+    return imported, skipped
+
+
+def run_import(movies=None, actors=None, cast=None, chunk_size=1000, name=None):
+    '''
+    run_import(movies, actors, cast, chunk_size, name)
+        imports the given files, movies and actors first so the casting links
+        can be resolved, and prints the throughput of each file. an import
+        with a name resumes where the last one with that name stopped.
+    '''
+    state = ImportState(name)
+    jobs = [
+        ('movies', movies, lambda path: import_entities(Movie, validate_movie, path, state, chunk_size)),
+        ('actors', actors, lambda path: import_entities(Actor, validate_actor, path, state, chunk_size)),
+        ('cast', cast, lambda path: import_links(path, state, chunk_size))
+    ]
+
+    for name, path, job in jobs:
+        if not path:
+            continue
+        start = time.perf_counter()
+        imported, skipped = job(path)
+        elapsed = time.perf_counter() - start
+        print('%s: %d rows imported, %d skipped in %.2f s (%.0f rows/s)' % (
+            name, imported, skipped, elapsed, imported / elapsed if elapsed else 0))
+    db.session.close()
@@ -0,0 +1,127 @@
+import os
+import time
+from functools import wraps
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Histogram
+
+'''
+Per-request timings of the hot path
+
+Each phase of a request (reading the bearer token, verifying the JWT,
+downloading the JWKS, checking the permissions, every SQL statement and the
+JSON encoding of the response by json_provider.dumps) is timed with
+time.perf_counter:
+- every call is observed by the request_phase_seconds histogram of
+  /metrics, labelled by phase, and every request by request_seconds,
+  labelled by endpoint.
+- the calls of one request are summed per phase and sent back in the
+  Server-Timing header, i.e.
+      Server-Timing: auth_header;dur=0.02, check_permissions;dur=0.01,
+                     sql;dur=1.84;desc="3 statements", serialize;dur=0.31, total;dur=2.95
+  durations in milliseconds. Phases nest: jwt_verify includes jwks_fetch,
+  which only happens when the keys are not cached.
+
+Recording a phase costs two perf_counter calls and a histogram update, a
+few microseconds, so it stays on in production. SERVER_TIMING=false only
+drops the header, i.e. to not disclose the timings to clients.
+'''
+
+# send the Server-Timing header with the responses
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() in ('1', 'true', 'yes')
+
+PHASE_SECONDS = Histogram('request_phase_seconds',
+                          'Time spent per call in each phase of the requests (see instrumentation.py)',
+                          buckets=(0.0001, 0.00025, 0.0005) + Histogram.DEFAULT_BUCKETS,
+                          labelnames=('phase',))
+REQUEST_SECONDS = Histogram('request_seconds', 'Time spent handling the requests, per endpoint',
+                            labelnames=('endpoint',))
+
+
+def record(phase, seconds):
+    '''
+    record(phase, seconds)
+        adds one call of phase, that took seconds, to the metrics and to the
+        timings of the current request, if any.
+    '''
+    PHASE_SECONDS.labels(phase).observe(seconds)
+    if has_request_context():
+        timings = g.get('timings')
+        if timings is not None:
+            total = timings.get(phase)
+            timings[phase] = (seconds, 1) if total is None else (total[0] + seconds, total[1] + 1)
+
+
+def timed(phase):
+    '''
+    timed(phase)
+        decorator recording every call of the decorated function as phase,
+        whether it returns or raises.
+    '''
+    def timed_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record(phase, time.perf_counter() - start)
+
+        return wrapper
+    return timed_decorator
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.instrumentation_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'instrumentation_start', None)
+    if start is not None:
+        record('sql', time.perf_counter() - start)
+
+
+def format_server_timing(timings, total):
+    '''
+    format_server_timing(timings, total)
+        returns the Server-Timing header value of the per-phase timings
+        {phase: (seconds, calls)} and the total seconds of the request.
+    '''
+    metrics = []
+    for phase, (seconds, calls) in timings.items():
+        metric = '%s;dur=%.2f' % (phase, seconds * 1000)
+        if phase == 'sql':
+            metric += ';desc="%d statement%s"' % (calls, '' if calls == 1 else 's')
+        metrics.append(metric)
+    metrics.append('total;dur=%.2f' % (total * 1000))
+    return ', '.join(metrics)
+
+
+def init_app(app):
+    '''
+    init_app(app)
+        times the requests of app.
+    '''
+    app.config.setdefault('SERVER_TIMING', SERVER_TIMING)
+
+    @app.before_request
+    def start_request_timer():
+        g.timings = {}
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        REQUEST_SECONDS.labels(request.endpoint or 'none').observe(total)
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = format_server_timing(g.timings, total)
+        return response
@@ -0,0 +1,132 @@
+import datetime
+import json
+import os
+import time
+
+from flask import current_app
+
+from instrumentation import record
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used without it
+    orjson = None
+
+'''
+JSON encoding of the responses
+
+The responses are encoded straight to bytes by the JSON provider of the app
+(app.json_provider), through json_response():
+- OrjsonProvider, the default when orjson is installed, encodes dicts, lists,
+  dates and datetimes natively.
+- StdlibJSONProvider, the fallback, uses the json module of the standard
+  library with the same output.
+
+Dates and datetimes are ISO 8601 strings (i.e. "1985-12-14T00:00:00"),
+SQLAlchemy rows (projections) objects of their columns and integer keys
+strings. Keys keep their order, so listings keep the order of their rows.
+
+JSON_PROVIDER (or app.config['JSON_PROVIDER']) picks the provider by name,
+or is any object with a dumps(obj) method returning bytes.
+'''
+
+# name of the JSON provider of the responses: orjson or stdlib
+JSON_PROVIDER = os.environ.get('JSON_PROVIDER', 'orjson' if orjson is not None else 'stdlib')
+
+
+def default(o):
+    '''
+    default(o)
+        encodes the values the providers do not know natively.
+    '''
+    if isinstance(o, datetime.date):
+        return o.isoformat()
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+class JSONProvider:
+    """
+    JSONProvider
+    Interface of a JSON provider: dumps(obj) returns the JSON document of obj as UTF-8 bytes.
+    """
+    name = None
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+
+class StdlibJSONProvider(JSONProvider):
+    """
+    StdlibJSONProvider
+    The json module of the standard library, compact and not escaping non-ASCII characters.
+    """
+    name = 'stdlib'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(default=default, ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode('utf-8')
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    OrjsonProvider
+    orjson, which encodes datetimes natively and writes bytes directly.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError('JSON_PROVIDER is orjson but orjson is not installed')
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+PROVIDERS = {provider.name: provider for provider in (StdlibJSONProvider, OrjsonProvider)}
+
+
+def get_json_provider(provider):
+    '''
+    get_json_provider(provider)
+        returns the provider named provider, or provider itself if it is not a name.
+        raise a ValueError if there is no provider of that name.
+    '''
+    if not isinstance(provider, str):
+        return provider
+    if provider not in PROVIDERS:
+        raise ValueError('unknown JSON_PROVIDER %r, expected one of %s' % (provider, ', '.join(PROVIDERS)))
+    return PROVIDERS[provider]()
+
+
+def init_app(app):
+    '''
+    init_app(app)
+        sets app.json_provider from app.config['JSON_PROVIDER'].
+    '''
+    app.config.setdefault('JSON_PROVIDER', JSON_PROVIDER)
+    app.json_provider = get_json_provider(app.config['JSON_PROVIDER'])
+
+
+def dumps(obj):
+    '''
+    dumps(obj)
+        returns obj encoded by the JSON provider of the current app, as bytes,
+        recorded as the serialize phase of the request.
+    '''
+    start = time.perf_counter()
+    try:
+        return current_app.json_provider.dumps(obj)
+    finally:
+        record('serialize', time.perf_counter() - start)
+
+
+def json_response(obj, status=200):
+    '''
+    json_response(obj, status)
+        returns a response with obj as its JSON body, like flask's jsonify.
+    '''
+    return current_app.response_class(dumps(obj), status=status, mimetype='application/json')
@@ -1,13 +1,44 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+from flask_script import Manager, Command, Option
+from flask_migrate import Migrate, MigrateCommand, stamp
 
-from app import app
+from app import create_app
 from models import db
+from importer import run_import
 
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
+
+class CreateDbCommand(Command):
+    """Creates the tables of a new database and marks it as migrated to the latest revision"""
+
+    def run(self):
+        db.create_all()
+        stamp()
+
+
+class ImportCommand(Command):
+    """Streams NDJSON or CSV files of movies, actors and casting links into the database"""
+
+    option_list = (
+        Option('--movies', help='file of movies: id (external), title, release_date'),
+        Option('--actors', help='file of actors: id (external), name, age, gender'),
+        Option('--cast', help='file of casting links: movie_id, actor_id (external ids)'),
+        Option('--chunk-size', dest='chunk_size', type=int, default=1000,
+               help='records written per transaction'),
+        Option('--name',
+               help='name of the import, whose progress is kept in the database; '
+                    'run again with the same name to resume an interrupted import'),
+    )
+
+    def run(self, movies, actors, cast, chunk_size, name):
+        run_import(movies, actors, cast, chunk_size, name)
+
+
 manager.add_command('db', MigrateCommand)
+manager.add_command('import', ImportCommand())
+manager.add_command('create_db', CreateDbCommand())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+import bisect
+import threading
+
+'''
+Process metrics in the Prometheus text format, served by GET /metrics.
+
+Every gunicorn worker keeps its own metrics; Prometheus scrapes each worker
+(or the numbers are summed by whatever aggregates them). Metrics are
+registered in REGISTRY when they are created, at import time.
+'''
+
+
+class Registry:
+    """
+    Registry
+    The metrics of the process, in the order they were created.
+    """
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self._metrics):
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Counter
+    A value that only goes up, i.e. the number of pool checkout timeouts.
+    With function, the value is read from function() at every scrape, for
+    counts kept by another object; a function returning None hides it.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, function=None, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [] if value is None else [(self.name, (), value)]
+
+
+class Gauge:
+    """
+    Gauge
+    A value that goes up and down. With function, the value is read from
+    function() at every scrape; a function returning None hides the gauge.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, function=None, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0
+        if registry is not None:
+            registry.register(self)
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [] if value is None else [(self.name, (), value)]
+
+
+class Histogram:
+    """
+    Histogram
+    Counts observations, i.e. durations in seconds, in cumulative buckets
+    bounded by buckets (upper bounds, ascending), along with their sum.
+    With labelnames, observations go to the child of each label value,
+    i.e. histogram.labels('sql').observe(0.002).
+    """
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.labelnames = tuple(labelnames)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(
+                    values, Histogram(self.name, self.documentation, self.buckets[:-1], registry=None))
+        return child
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        if self.labelnames:
+            with self._lock:
+                children = sorted(self._children.items())
+            samples = []
+            for values, child in children:
+                labels = tuple(zip(self.labelnames, values))
+                samples.extend((name, labels + child_labels, value) for name, child_labels, value in child.samples())
+            return samples
+
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append((self.name + '_bucket', (('le', format_value(float(bound))),), cumulative))
+        samples.append((self.name + '_count', (), cumulative))
+        samples.append((self.name + '_sum', (), total))
+        return samples
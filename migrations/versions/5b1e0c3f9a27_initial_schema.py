@@ -0,0 +1,49 @@
+"""initial schema
+
+Revision ID: 5b1e0c3f9a27
+Revises: 
+Create Date: 2026-10-18 09:12:41.308514
+
+Databases created before migrations were tracked already hold this schema
+(db.create_all()), unnamed foreign keys included; mark them with
+`python manage.py db stamp 5b1e0c3f9a27` before upgrading.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e0c3f9a27'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movie',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(length=255), nullable=False),
+    sa.Column('release_date', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('actor',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=255), nullable=False),
+    sa.Column('age', sa.Integer(), nullable=True),
+    sa.Column('gender', sa.String(length=25), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('actor_movie',
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actor.id'], ),
+    sa.ForeignKeyConstraint(['movie_id'], ['movie.id'], ),
+    sa.PrimaryKeyConstraint('actor_id', 'movie_id')
+    )
+
+
+def downgrade():
+    op.drop_table('actor_movie')
+    op.drop_table('actor')
+    op.drop_table('movie')
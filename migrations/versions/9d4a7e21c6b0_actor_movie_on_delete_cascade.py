@@ -0,0 +1,50 @@
+"""actor_movie on delete cascade
+
+The foreign keys of actor_movie are found by reflection: databases created
+by db.create_all() have the names postgresql gives them, and unnamed ones on
+sqlite, which cannot alter constraints and gets a copy of the table instead.
+
+Revision ID: 9d4a7e21c6b0
+Revises: b2d6f08e3c71
+Create Date: 2026-10-18 10:03:17.552190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4a7e21c6b0'
+down_revision = 'b2d6f08e3c71'
+branch_labels = None
+depends_on = None
+
+
+def cast_table(ondelete):
+    return sa.Table('actor_movie', sa.MetaData(),
+        sa.Column('actor_id', sa.Integer(), sa.ForeignKey('actor.id', ondelete=ondelete), primary_key=True),
+        sa.Column('movie_id', sa.Integer(), sa.ForeignKey('movie.id', ondelete=ondelete), primary_key=True),
+        sa.Index('ix_actor_movie_movie_id', 'movie_id')
+    )
+
+
+def set_ondelete(ondelete):
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        with op.batch_alter_table('actor_movie', recreate='always', copy_from=cast_table(ondelete)):
+            pass
+        return
+
+    for foreign_key in sa.inspect(bind).get_foreign_keys('actor_movie'):
+        op.drop_constraint(foreign_key['name'], 'actor_movie', type_='foreignkey')
+        op.create_foreign_key(foreign_key['name'], 'actor_movie', foreign_key['referred_table'],
+                              foreign_key['constrained_columns'], foreign_key['referred_columns'],
+                              ondelete=ondelete)
+
+
+def upgrade():
+    set_ondelete('CASCADE')
+
+
+def downgrade():
+    set_ondelete(None)
@@ -0,0 +1,37 @@
+"""import_progress and import_key tables
+
+Revision ID: a86d3e5c1f47
+Revises: f41a9c7d2e58
+Create Date: 2026-10-18 18:11:05.208734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a86d3e5c1f47'
+down_revision = 'f41a9c7d2e58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_progress',
+        sa.Column('name', sa.String(length=255), nullable=False),
+        sa.Column('source', sa.String(length=64), nullable=False),
+        sa.Column('done', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'source')
+    )
+    op.create_table('import_key',
+        sa.Column('name', sa.String(length=255), nullable=False),
+        sa.Column('source', sa.String(length=64), nullable=False),
+        sa.Column('external_id', sa.String(length=255), nullable=False),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'source', 'external_id')
+    )
+
+
+def downgrade():
+    op.drop_table('import_key')
+    op.drop_table('import_progress')
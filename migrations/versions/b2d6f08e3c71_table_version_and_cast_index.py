@@ -0,0 +1,31 @@
+"""table_version counters and the index of the cast of a movie
+
+Revision ID: b2d6f08e3c71
+Revises: 5b1e0c3f9a27
+Create Date: 2026-10-18 09:47:05.861290
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d6f08e3c71'
+down_revision = '5b1e0c3f9a27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actor_movie_movie_id', 'actor_movie', ['movie_id'], unique=False)
+    table_version = op.create_table('table_version',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [{'name': name, 'version': 0} for name in ('movie', 'actor', 'actor_movie')])
+
+
+def downgrade():
+    op.drop_table('table_version')
+    op.drop_index('ix_actor_movie_movie_id', table_name='actor_movie')
@@ -0,0 +1,79 @@
+"""search indexes on movie titles and actor names
+
+On postgresql: a generated tsvector column with a GIN index per table, and
+trigram indexes when the pg_trgm extension can be installed. On sqlite: FTS5
+tables kept up to date by triggers.
+
+Revision ID: c3f18a5d2b64
+Revises: 9d4a7e21c6b0
+Create Date: 2026-10-18 11:41:05.318472
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f18a5d2b64'
+down_revision = '9d4a7e21c6b0'
+branch_labels = None
+depends_on = None
+
+SEARCH_FIELDS = (('movie', 'title'), ('actor', 'name'))
+
+
+def trigram_available(bind):
+    return bind.execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first() is not None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        trigram = trigram_available(bind)
+        if trigram:
+            op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, column in SEARCH_FIELDS:
+            op.execute("ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+                       "GENERATED ALWAYS AS (to_tsvector('simple', coalesce({column}, ''))) STORED"
+                       .format(table=table, column=column))
+            op.execute('CREATE INDEX ix_{table}_search_vector ON {table} USING gin (search_vector)'
+                       .format(table=table))
+            if trigram:
+                op.execute('CREATE INDEX ix_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)'
+                           .format(table=table, column=column))
+
+    elif bind.dialect.name == 'sqlite':
+        for table, column in SEARCH_FIELDS:
+            names = {'table': table, 'column': column}
+            op.execute("CREATE VIRTUAL TABLE {table}_fts USING fts5({column}, content='{table}', content_rowid='id')"
+                       .format(**names))
+            op.execute("CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+                       "INSERT INTO {table}_fts (rowid, {column}) VALUES (new.id, new.{column}); END"
+                       .format(**names))
+            op.execute("CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+                       "INSERT INTO {table}_fts ({table}_fts, rowid, {column}) "
+                       "VALUES ('delete', old.id, old.{column}); END"
+                       .format(**names))
+            op.execute("CREATE TRIGGER {table}_fts_update AFTER UPDATE OF {column} ON {table} BEGIN "
+                       "INSERT INTO {table}_fts ({table}_fts, rowid, {column}) "
+                       "VALUES ('delete', old.id, old.{column}); "
+                       "INSERT INTO {table}_fts (rowid, {column}) VALUES (new.id, new.{column}); END"
+                       .format(**names))
+            # index the rows that are already there
+            op.execute("INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')".format(**names))
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        for table, column in SEARCH_FIELDS:
+            op.execute('DROP INDEX IF EXISTS ix_{table}_{column}_trgm'.format(table=table, column=column))
+            op.execute('DROP INDEX ix_{table}_search_vector'.format(table=table))
+            op.execute('ALTER TABLE {table} DROP COLUMN search_vector'.format(table=table))
+
+    elif bind.dialect.name == 'sqlite':
+        for table, column in SEARCH_FIELDS:
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute('DROP TRIGGER {table}_fts_{trigger}'.format(table=table, trigger=trigger))
+            op.execute('DROP TABLE {table}_fts'.format(table=table))
@@ -0,0 +1,28 @@
+"""indexes for the age, gender and release date filters
+
+Revision ID: e7b2c94f1a03
+Revises: c3f18a5d2b64
+Create Date: 2026-10-18 13:20:48.906115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b2c94f1a03'
+down_revision = 'c3f18a5d2b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actor_age', 'actor', ['age'])
+    op.create_index('ix_actor_gender_id', 'actor', ['gender', 'id'])
+    op.create_index('ix_movie_release_date', 'movie', ['release_date'])
+
+
+def downgrade():
+    op.drop_index('ix_movie_release_date', table_name='movie')
+    op.drop_index('ix_actor_gender_id', table_name='actor')
+    op.drop_index('ix_actor_age', table_name='actor')
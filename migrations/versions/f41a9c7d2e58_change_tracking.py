@@ -0,0 +1,53 @@
+"""created_at and updated_at columns and the change_log table
+
+The rows already there get the time of the migration as created_at and
+updated_at. sqlite cannot add a NOT NULL column without a constant default,
+so the columns stay nullable there; the app always sets them.
+
+Revision ID: f41a9c7d2e58
+Revises: e7b2c94f1a03
+Create Date: 2026-10-18 16:02:37.514208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f41a9c7d2e58'
+down_revision = 'e7b2c94f1a03'
+branch_labels = None
+depends_on = None
+
+TRACKED_TABLES = ('movie', 'actor')
+
+
+def upgrade():
+    bind = op.get_bind()
+    now = "timezone('utc', now())" if bind.dialect.name == 'postgresql' else 'CURRENT_TIMESTAMP'
+    for table in TRACKED_TABLES:
+        for column in ('created_at', 'updated_at'):
+            op.add_column(table, sa.Column(column, sa.DateTime(), nullable=True))
+            op.execute('UPDATE {table} SET {column} = {now}'.format(table=table, column=column, now=now))
+            if bind.dialect.name != 'sqlite':
+                op.alter_column(table, column, nullable=False)
+
+    op.create_table('change_log',
+        sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+        sa.Column('table_name', sa.String(length=64), nullable=False),
+        sa.Column('row_id', sa.Integer(), nullable=False),
+        sa.Column('operation', sa.String(length=6), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    table_version = sa.table('table_version', sa.column('name'), sa.column('version'))
+    op.bulk_insert(table_version, [{'name': 'change_log', 'version': 0}])
+
+
+def downgrade():
+    op.execute("DELETE FROM table_version WHERE name = 'change_log'")
+    op.drop_table('change_log')
+    for table in TRACKED_TABLES:
+        # sqlite (3.35 and later) drops the columns in place, its FTS triggers stay
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'created_at')
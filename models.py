@@ -1,32 +1,203 @@
+from datetime import datetime
+from dateutil import parser as date_parser
 from flask_sqlalchemy import SQLAlchemy
+from functools import lru_cache
+from sqlalchemy import DDL, DateTime, event, func, inspect, literal_column, or_, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.sql import column as sql_column, table as sql_table
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, validates
+import operator
 import os
+import re
+import sqlite3
+import time
 from dotenv import load_dotenv
-
-load_dotenv()
-
-user_name = os.environ.get('DB_USER')
-password = os.environ.get('DB_PASSWORD')
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from metrics import Counter, Gauge, Histogram
 
 database_name = "lav_cast_agency"
-# database_path = "postgresql://" + user_name + ":" + password + "@{}/{}".format('localhost:5432', database_name)
-database_path = os.getenv("DATABASE_URL")
-if database_path.startswith("postgres://"):  # workaround to make it work in heroku
-    database_path.replace('postgres://', 'postgresql://', 1)
 
 db = SQLAlchemy()
+
+
+def get_database_path():
+    '''
+    get_database_path()
+        returns DATABASE_URL, read from the environment when the app is
+        created rather than on import.
+    '''
+    # database_path = "postgresql://" + user_name + ":" + password + "@{}/{}".format('localhost:5432', database_name)
+    database_path = os.getenv("DATABASE_URL")
+    if database_path is None:
+        raise RuntimeError('DATABASE_URL is not set')
+    if database_path.startswith("postgres://"):  # workaround to make it work in heroku
+        database_path = database_path.replace('postgres://', 'postgresql://', 1)
+    return database_path
+
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    nothing connects to the database until the first query; the tables are
+    created by `python manage.py create_db` (or the migrations), not here.
 '''
 
 
-def setup_db(app, db_path=database_path):
-    print(db_path)
+def setup_db(app, db_path=None):
+    load_dotenv()
+    if db_path is None:
+        db_path = get_database_path()
     app.config["SQLALCHEMY_DATABASE_URI"] = db_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    for key, value in get_engine_settings().items():
+        app.config.setdefault(key, value)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config, db_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+'''
+Connection pool
+    every gunicorn worker has its own pool: at most DB_POOL_SIZE +
+    DB_MAX_OVERFLOW connections per worker, so size them against the
+    max_connections of the database (or of PgBouncer) divided by the workers.
+    each setting may be overridden in the config of the app.
+'''
+
+
+def get_engine_settings():
+    '''
+    get_engine_settings()
+        returns the DB_* settings of the environment, with their defaults.
+    '''
+    return {
+        'DB_POOL_SIZE': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'DB_MAX_OVERFLOW': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        # seconds to wait for a free connection before giving up
+        'DB_POOL_TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        # seconds after which a connection is replaced, -1 never
+        'DB_POOL_RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        # test connections on checkout, so one broken by a database restart is replaced instead of failing a request
+        'DB_POOL_PRE_PING': os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+        # milliseconds a statement may run on postgresql, 0 no limit
+        'DB_STATEMENT_TIMEOUT': int(os.environ.get('DB_STATEMENT_TIMEOUT', 0)),
+        # connections go through PgBouncer in transaction pooling mode
+        'DB_PGBOUNCER': os.environ.get('DB_PGBOUNCER', 'false').lower() in ('1', 'true', 'yes')
+    }
+
+
+POOL_CHECKOUT_SECONDS = Histogram('db_pool_checkout_seconds',
+                                  'Time spent waiting for (or opening) a database connection')
+POOL_TIMEOUTS = Counter('db_pool_checkout_timeouts_total',
+                        'Connection checkouts that gave up after DB_POOL_TIMEOUT')
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    InstrumentedQueuePool
+        QueuePool that records how long checkouts wait for a connection.
+    '''
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - start)
+
+
+def pool_status(name):
+    '''
+    pool_status(name)
+        returns the size, checkedout or overflow count of the connection pool
+        of the current app, or None outside an app or for pools without them (sqlite).
+    '''
+    try:
+        pool = db.engine.pool
+    except RuntimeError:
+        return None
+    return getattr(pool, name)() if isinstance(pool, QueuePool) else None
+
+
+Gauge('db_pool_size', 'Connections the pool keeps open', lambda: pool_status('size'))
+Gauge('db_pool_checked_out', 'Connections in use', lambda: pool_status('checkedout'))
+Gauge('db_pool_overflow', 'Connections open beyond db_pool_size (negative while the pool fills)',
+      lambda: pool_status('overflow'))
+
+
+def engine_options(config, db_path):
+    '''
+    engine_options(config, db_path)
+        returns the SQLALCHEMY_ENGINE_OPTIONS for the DB_* settings of config.
+        sqlite keeps the pool flask_sqlalchemy picks for it.
+    '''
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE']
+    }
+    if db_path.startswith('sqlite'):
+        return options
+
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT']
+    })
+    timeout = config['DB_STATEMENT_TIMEOUT']
+    if timeout and db_path.startswith('postgres'):
+        if config['DB_PGBOUNCER']:
+            # PgBouncer rejects startup options, the timeout is set per transaction by set_statement_timeout.
+            # psycopg2 never prepares statements server side, which transaction pooling would break too.
+            options['execution_options'] = {'pgbouncer_statement_timeout': timeout}
+        else:
+            options['connect_args'] = {'options': '-c statement_timeout=%d' % timeout}
+    return options
+
+
+@event.listens_for(Engine, 'begin')
+def set_statement_timeout(connection):
+    # PgBouncer mode: a session setting would leak to the other clients of the
+    # server connection, so the timeout only holds for the transaction
+    timeout = connection.get_execution_options().get('pgbouncer_statement_timeout')
+    if timeout:
+        connection.exec_driver_sql('SET LOCAL statement_timeout = %d' % timeout)
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # sqlite ignores foreign keys, and so ON DELETE CASCADE, unless asked per connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+class utcnow(FunctionElement):
+    '''
+    utcnow()
+        the current UTC time as a naive timestamp, the time the transaction
+        started on postgresql (so the columns set by one statement are equal).
+    '''
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow, 'postgresql')
+def compile_utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow)
+def compile_utcnow(element, compiler, **kw):
+    # sqlite: UTC already, to the second
+    return 'CURRENT_TIMESTAMP'
 
 
 def db_drop_and_create_all():
@@ -34,6 +205,154 @@ def db_drop_and_create_all():
     db.create_all()
 
 
+def keyset_page(query, column, cursor=None, limit=None):
+    '''
+    keyset_page(query, column, cursor, limit)
+        returns one page of query ordered by column (WHERE column > cursor
+        ORDER BY column LIMIT limit) and the cursor of the next page, which is
+        None on the last page.
+    '''
+    if cursor is not None:
+        query = query.filter(column > cursor)
+    rows = query.order_by(column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return rows, next_cursor
+
+
+def stream_query(query, batch_size):
+    '''
+    stream_query(query, batch_size)
+        iterates over the rows of query through a server side cursor (on
+        postgresql), buffering only batch_size rows at a time.
+    '''
+    return query.execution_options(stream_results=True).yield_per(batch_size)
+
+
+def update_returning(model, id, values):
+    '''
+    update_returning(model, id, values)
+        sets the values (a dictionary of column values) of the row of model
+        with primary key id and commits. on postgresql this is a single
+        UPDATE ... RETURNING statement; databases without RETURNING get the
+        UPDATE and a SELECT.
+        returns the updated row, or None if there is no such row.
+    '''
+    table = model.__table__
+    by_id = table.c.id == id
+    if not values:
+        row = db.session.execute(table.select().where(by_id)).first()
+    elif db.engine.dialect.full_returning:
+        row = db.session.execute(table.update().where(by_id).values(values).returning(*table.c)).first()
+    elif db.session.execute(table.update().where(by_id).values(values)).rowcount:
+        row = db.session.execute(table.select().where(by_id)).first()
+    else:
+        row = None
+
+    if row is not None and values:
+        touch(table.name)
+        log_changes([(table.name, id, UPDATE)])
+    db.session.commit()
+    return row
+
+
+def delete_row(model, id):
+    '''
+    delete_row(model, id)
+        deletes the row of model with primary key id with a single DELETE
+        statement (its actor_movie rows go with it, ON DELETE CASCADE) and
+        commits. returns whether the row existed.
+    '''
+    table = model.__table__
+    deleted = db.session.execute(table.delete().where(table.c.id == id)).rowcount
+    if deleted:
+        touch(table.name, actor_movie.name)
+        log_changes([(table.name, id, DELETE)])
+    db.session.commit()
+    return deleted > 0
+
+
+# range of the Integer columns (ids, age), 32 bit signed as on postgresql
+MIN_INTEGER = -2 ** 31
+MAX_INTEGER = 2 ** 31 - 1
+
+
+def in_integer_range(value):
+    '''
+    in_integer_range(value)
+        returns whether the int value fits an Integer column.
+    '''
+    return MIN_INTEGER <= value <= MAX_INTEGER
+
+
+def parse_int(value):
+    '''
+    parse_int(value)
+        returns value as an int, or None if it is None.
+        raise ValueError if value is not a number or does not fit an Integer column.
+    '''
+    if value is None:
+        return None
+    value = int(value)
+    if not in_integer_range(value):
+        raise ValueError('%d is out of range' % value)
+    return value
+
+
+def parse_date(value):
+    '''
+    parse_date(value)
+        returns value as a datetime, parsing strings such as '1984-1-1'.
+        raise ValueError if value is not a date.
+    '''
+    if value is None or isinstance(value, datetime):
+        return value
+    if not isinstance(value, str):
+        raise ValueError('a date must be a string')
+    return date_parser.parse(value)
+
+
+# number of rows sent in one INSERT statement by bulk_insert
+BULK_CHUNK_SIZE = 1000
+
+
+def bulk_insert(model, rows):
+    '''
+    bulk_insert(model, rows)
+        inserts rows (dictionaries with the same column keys) in one
+        transaction and returns their new ids, in order. on postgresql each
+        chunk of BULK_CHUNK_SIZE rows is a single INSERT ... VALUES ... RETURNING id;
+        databases without RETURNING get one INSERT per row.
+    '''
+    ids = insert_rows(model, rows)
+    db.session.commit()
+    return ids
+
+
+def insert_rows(model, rows):
+    '''
+    insert_rows(model, rows)
+        the statements of bulk_insert, without committing.
+    '''
+    table = model.__table__
+    ids = []
+    if db.engine.dialect.full_returning:
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            chunk = rows[start:start + BULK_CHUNK_SIZE]
+            result = db.session.execute(table.insert().values(chunk).returning(table.c.id))
+            ids.extend(row.id for row in result)
+    else:
+        for row in rows:
+            result = db.session.execute(table.insert().values(row))
+            ids.append(result.inserted_primary_key[0])
+    touch(table.name)
+    log_changes([(table.name, id, INSERT) for id in ids])
+    return ids
+
+
 def create_test_data():
     a_movie = Movie(
         title='TestDune',
@@ -48,16 +367,209 @@ def create_test_data():
     an_actor.insert()
 
 
+'''
+Table_Version
+one generation counter per table, bumped in the same transaction as every
+write to the table. Caches key their entries by these versions, so a write
+made by any worker invalidates them.
+'''
+
+table_version = db.Table('table_version',
+    db.Column('name', db.String(64), primary_key=True),
+    db.Column('version', db.BigInteger, nullable=False, default=0)
+)
+
+VERSIONED_TABLES = ('movie', 'actor', 'actor_movie', 'change_log')
+
+
+@event.listens_for(table_version, 'after_create')
+def seed_table_version(target, connection, **kw):
+    connection.execute(target.insert(), [{'name': name, 'version': 0} for name in VERSIONED_TABLES])
+
+
+def touch(*names, session=None):
+    '''
+    touch(*names, session)
+        bumps the version of the named tables, without committing, in session
+        (db.session by default).
+    '''
+    (session or db.session).execute(table_version.update()
+                                    .where(table_version.c.name.in_(names))
+                                    .values(version=table_version.c.version + 1))
+
+
+def get_versions(names):
+    '''
+    get_versions(names)
+        returns the current versions of the named tables as a tuple, in the
+        order of names, or None if one of them is not tracked.
+    '''
+    versions = dict(db.session.execute(
+        db.select([table_version.c.name, table_version.c.version])
+        .where(table_version.c.name.in_(names))).fetchall())
+    if len(versions) != len(names):
+        return None
+    return tuple(versions[name] for name in names)
+
+
+'''
+Change_Log
+one entry per insert, update or delete of a movie or an actor, and per change
+of the cast of a movie (the row_id of an actor_movie entry is the movie id),
+written in the same transaction as the change. Its id is the cursor of the
+GET /changes feed.
+Before adding entries a transaction bumps the change_log version, which locks
+that table_version row until it commits: ids are handed out in commit order,
+so a reader that has seen an id never misses a smaller one committed later.
+The deletes of actor_movie rows by ON DELETE CASCADE are not logged; the
+delete entry of a movie or an actor stands for them.
+'''
+
+change_log = db.Table('change_log',
+    # sqlite only autoincrements INTEGER primary keys
+    db.Column('id', db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True),
+    db.Column('table_name', db.String(64), nullable=False),
+    db.Column('row_id', db.Integer, nullable=False),
+    db.Column('operation', db.String(6), nullable=False),
+    db.Column('changed_at', db.DateTime, nullable=False, default=utcnow())
+)
+
+INSERT, UPDATE, DELETE = 'insert', 'update', 'delete'
+
+
+def log_changes(entries, session=None):
+    '''
+    log_changes(entries, session)
+        adds the entries, (table name, row id, operation) tuples, to
+        change_log in session (db.session by default), without committing.
+    '''
+    if not entries:
+        return
+    session = session or db.session
+    touch(change_log.name, session=session)
+    session.execute(change_log.insert(), [{'table_name': name, 'row_id': row_id, 'operation': operation}
+                                          for name, row_id, operation in entries])
+
+
+def cast_changes(instance):
+    '''
+    cast_changes(instance)
+        returns the ids of the movies whose cast a flush of instance (a Movie
+        or an Actor) changes through Movie.actors or Actor.movies.
+    '''
+    if isinstance(instance, Movie):
+        history = inspect(instance).attrs.actors.history
+        return [instance.id] if history.added or history.deleted else []
+    history = inspect(instance).attrs.movies.history
+    # an unloaded collection has no history (None)
+    return [movie.id for movie in list(history.added or ()) + list(history.deleted or ())]
+
+
+@event.listens_for(Session, 'after_flush')
+def log_flushed_changes(session, flush_context):
+    # the insert, update and delete methods of the models go through the
+    # session; new, dirty, deleted and the attribute history still describe
+    # the flush here
+    entries = []
+    movie_ids = set()
+    for operation, instances in ((INSERT, session.new), (UPDATE, session.dirty), (DELETE, session.deleted)):
+        for instance in instances:
+            if not isinstance(instance, (Movie, Actor)):
+                continue
+            if operation != UPDATE or session.is_modified(instance, include_collections=False):
+                entries.append((instance.__tablename__, instance.id, operation))
+            if operation != DELETE:
+                movie_ids.update(cast_changes(instance))
+    entries.extend((actor_movie.name, movie_id, UPDATE) for movie_id in sorted(movie_ids))
+    log_changes(entries, session)
+
+
+'''
+Import_Progress, Import_Key
+state of the named imports of importer.py: the number of records of each
+source table (movie, actor, actor_movie) read so far, and the primary key
+assigned to each external id. Written in the transaction of the chunk they
+describe, so a resumed import neither repeats nor skips a chunk.
+'''
+
+import_progress = db.Table('import_progress',
+    db.Column('name', db.String(255), primary_key=True),
+    db.Column('source', db.String(64), primary_key=True),
+    db.Column('done', db.Integer, nullable=False)
+)
+
+import_key = db.Table('import_key',
+    db.Column('name', db.String(255), primary_key=True),
+    db.Column('source', db.String(64), primary_key=True),
+    db.Column('external_id', db.String(255), primary_key=True),
+    db.Column('id', db.Integer, nullable=False)
+)
+
+
 '''
 Actor_Movie
 helper table
 '''
 
 actor_movie = db.Table('actor_movie',
-    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id'), primary_key=True),
-    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id'), primary_key=True)
+    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True),
+    # the primary key only serves lookups by actor_id, this one serves the cast of a movie
+    db.Index('ix_actor_movie_movie_id', 'movie_id')
 )
 
+
+def dialect_insert(table):
+    '''
+    dialect_insert(table)
+        returns the INSERT construct of the bound database dialect, which
+        supports on_conflict_do_nothing() on postgresql and sqlite.
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def link_actors(rows):
+    '''
+    link_actors(rows)
+        inserts the actor_movie rows ({'movie_id': ..., 'actor_id': ...}) with
+        one multi-row INSERT ... ON CONFLICT DO NOTHING, without committing.
+        returns the number of new links.
+    '''
+    added = db.session.execute(dialect_insert(actor_movie).values(rows).on_conflict_do_nothing()).rowcount
+    if added:
+        touch(actor_movie.name)
+        log_changes([(actor_movie.name, movie_id, UPDATE) for movie_id in sorted({row['movie_id'] for row in rows})])
+    return added
+
+
+def cast_actors(movie_id, actor_ids):
+    '''
+    cast_actors(movie_id, actor_ids)
+        links all actors to the movie with one statement and one commit.
+        returns the number of new links.
+    '''
+    added = link_actors([{'movie_id': movie_id, 'actor_id': actor_id} for actor_id in set(actor_ids)])
+    db.session.commit()
+    return added
+
+
+def uncast_actors(movie_id, actor_ids):
+    '''
+    uncast_actors(movie_id, actor_ids)
+        unlinks all actors from the movie with one DELETE and one commit.
+        returns the number of removed links.
+    '''
+    result = db.session.execute(actor_movie.delete().where(
+        actor_movie.c.movie_id == movie_id,
+        actor_movie.c.actor_id.in_(actor_ids)))
+    if result.rowcount:
+        touch(actor_movie.name)
+        log_changes([(actor_movie.name, movie_id, UPDATE)])
+    db.session.commit()
+    return result.rowcount
+
 '''
 Movie
 Have title and release date
@@ -65,29 +577,69 @@ Have title and release date
 
 
 class Movie(db.Model):
+    # columns a client may select with format(fields=...)
+    FIELDS = ('id', 'title', 'release_date', 'created_at', 'updated_at')
+    # relationships a client may request with format(include=...)
+    RELATIONS = ('actors',)
+    # column matched by ?q= searches
+    SEARCH_FIELD = 'title'
+    # query parameters a listing may be filtered by: (column, comparison, conversion of the value)
+    FILTERS = {
+        'released_after': ('release_date', operator.ge, parse_date),
+        'released_before': ('release_date', operator.le, parse_date)
+    }
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     release_date = db.Column(db.DateTime, nullable=True)
-    actors = db.relationship('Actor', secondary=actor_movie, lazy='subquery',
-                             backref=db.backref('movies', lazy=True))
+    # set on insert and on every update of the row (utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow())
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow(), onupdate=utcnow())
+    __table_args__ = (
+        db.Index('ix_movie_release_date', 'release_date'),
+    )
+    # nothing is loaded eagerly by default, queries opt in with selectinload()
+    # the database removes the actor_movie rows of a deleted movie or actor (ON DELETE CASCADE)
+    actors = db.relationship('Actor', secondary=actor_movie, lazy='select', passive_deletes=True,
+                             backref=db.backref('movies', lazy='select', passive_deletes=True))
+
+    @classmethod
+    def exists(cls, id):
+        return db.session.query(cls.query.filter(cls.id == id).exists()).scalar()
 
     def insert(self):
         db.session.add(self)
+        touch(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        # the cast may have changed along with the row
+        touch(self.__tablename__, actor_movie.name)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        touch(self.__tablename__, actor_movie.name)
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date
-        }
+    @validates('release_date')
+    def validate_release_date(self, key, value):
+        return parse_date(value)
+
+    def format(self, fields=None, include=()):
+        if fields is not None:
+            formatted = {field: getattr(self, field) for field in fields}
+        else:
+            formatted = {
+                'id': self.id,
+                'title': self.title,
+                'release_date': self.release_date,
+                'created_at': self.created_at,
+                'updated_at': self.updated_at
+            }
+        if 'actors' in include:
+            formatted['actors'] = [actor.format() for actor in self.actors]
+        return formatted
 
     def __repr__(self):
         return '<Title %r>' % self.title
@@ -100,32 +652,171 @@ Have name, age and gender
 
 
 class Actor(db.Model):
+    # columns a client may select with format(fields=...)
+    FIELDS = ('id', 'name', 'age', 'gender', 'created_at', 'updated_at')
+    # relationships a client may request with format(include=...)
+    RELATIONS = ('movies',)
+    # column matched by ?q= searches
+    SEARCH_FIELD = 'name'
+    # query parameters a listing may be filtered by: (column, comparison, conversion of the value)
+    FILTERS = {
+        'age_min': ('age', operator.ge, parse_int),
+        'age_max': ('age', operator.le, parse_int),
+        'gender': ('gender', operator.eq, str)
+    }
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
     age = db.Column(db.Integer, nullable=True)
     gender = db.Column(db.String(25), nullable=True)
+    # set on insert and on every update of the row (utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow())
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow(), onupdate=utcnow())
+    __table_args__ = (
+        db.Index('ix_actor_age', 'age'),
+        # gender first, then id: a gender filter reads the index in keyset (id) order
+        db.Index('ix_actor_gender_id', 'gender', 'id'),
+    )
+
+    @classmethod
+    def exists(cls, id):
+        return db.session.query(cls.query.filter(cls.id == id).exists()).scalar()
 
     def insert(self):
         db.session.add(self)
+        touch(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        # the cast may have changed along with the row
+        touch(self.__tablename__, actor_movie.name)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        touch(self.__tablename__, actor_movie.name)
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender
-        }
+    @validates('age')
+    def validate_age(self, key, value):
+        return parse_int(value)
+
+    def format(self, fields=None, include=()):
+        if fields is not None:
+            formatted = {field: getattr(self, field) for field in fields}
+        else:
+            formatted = {
+                'id': self.id,
+                'name': self.name,
+                'age': self.age,
+                'gender': self.gender,
+                'created_at': self.created_at,
+                'updated_at': self.updated_at
+            }
+        if 'movies' in include:
+            formatted['movies'] = [movie.format() for movie in self.movies]
+        return formatted
 
     def __repr__(self):
         return '<name %r>' % self.name
 
 
+'''
+Search
+    the SEARCH_FIELD of movies and actors is searchable by word prefix.
+    on postgresql the table has a search_vector column, a generated tsvector,
+    with a GIN index, and a trigram index on the field itself when the
+    pg_trgm extension is installed, which also finds words by any part.
+    on sqlite an FTS5 table kept up to date by triggers indexes the field.
+    the migrations create the same objects as create_all does here.
+'''
+
+POSTGRESQL_SEARCH_DDL = (
+    "ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', coalesce({column}, ''))) STORED",
+    "CREATE INDEX ix_{table}_search_vector ON {table} USING gin (search_vector)"
+)
+TRIGRAM_DDL = "CREATE INDEX ix_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)"
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE {table}_fts USING fts5({column}, content='{table}', content_rowid='id')",
+    "CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}_fts (rowid, {column}) VALUES (new.id, new.{column}); END",
+    "CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}_fts ({table}_fts, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+    "CREATE TRIGGER {table}_fts_update AFTER UPDATE OF {column} ON {table} BEGIN "
+    "INSERT INTO {table}_fts ({table}_fts, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+    "INSERT INTO {table}_fts (rowid, {column}) VALUES (new.id, new.{column}); END"
+)
+
 
+def trigram_installed(ddl, target, bind, **kw):
+    return bind.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+
+
+def add_search_index(model):
+    names = {'table': model.__tablename__, 'column': model.SEARCH_FIELD}
+    for statement in POSTGRESQL_SEARCH_DDL:
+        event.listen(model.__table__, 'after_create',
+                     DDL(statement.format(**names)).execute_if(dialect='postgresql'))
+    event.listen(model.__table__, 'after_create',
+                 DDL(TRIGRAM_DDL.format(**names)).execute_if(dialect='postgresql', callable_=trigram_installed))
+    for statement in SQLITE_SEARCH_DDL:
+        event.listen(model.__table__, 'after_create',
+                     DDL(statement.format(**names)).execute_if(dialect='sqlite'))
+    # the FTS5 table is not part of the metadata, drop_all would leave it behind
+    event.listen(model.__table__, 'before_drop',
+                 DDL('DROP TABLE IF EXISTS {table}_fts'.format(**names)).execute_if(dialect='sqlite'))
+
+
+add_search_index(Movie)
+add_search_index(Actor)
+
+
+@lru_cache()
+def has_trigram_index(url, table, column):
+    return db.session.execute(text('SELECT 1 FROM pg_indexes WHERE indexname = :name'),
+                              {'name': 'ix_%s_%s_trgm' % (table, column)}).first() is not None
+
+
+def search_words(value):
+    return re.findall(r'\w+', value.lower())
+
+
+def search_page(query, model, value, offset=0, limit=None):
+    '''
+    search_page(query, model, value, offset, limit)
+        returns one page of the rows of query whose SEARCH_FIELD starts a word
+        with every word of value (or holds value anywhere, where a trigram
+        index exists), best match first, and the offset of the next page,
+        which is None on the last page.
+    '''
+    words = search_words(value)
+    if not words:
+        return [], None
+
+    table = model.__tablename__
+    column = getattr(model, model.SEARCH_FIELD)
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        vector = literal_column(table + '.search_vector')
+        tsquery = func.to_tsquery('simple', ' & '.join(word + ':*' for word in words))
+        match = vector.op('@@')(tsquery)
+        if has_trigram_index(str(db.engine.url), table, model.SEARCH_FIELD):
+            pattern = re.sub(r'([\\%_])', r'\\\1', value)
+            match = or_(match, column.ilike('%' + pattern + '%', escape='\\'))
+        # normalization 1 ranks shorter fields higher among equal matches
+        query = query.filter(match).order_by(func.ts_rank(vector, tsquery, 1).desc(), model.id)
+    elif dialect == 'sqlite':
+        fts = sql_table(table + '_fts', sql_column('rowid'), sql_column('rank'))
+        query = query.join(fts, fts.c.rowid == model.id) \
+            .filter(literal_column(fts.name).op('MATCH')(' '.join('"%s"*' % word for word in words))) \
+            .order_by(fts.c.rank, model.id)
+    else:
+        query = query.filter(*[column.ilike('%' + word + '%') for word in words]).order_by(model.id)
+
+    rows = query.offset(offset).limit(limit + 1).all()
+    next_offset = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_offset = offset + limit
+    return rows, next_offset
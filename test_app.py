@@ -1,10 +1,27 @@
+import datetime
+import gzip
 import unittest
+import zlib
 import json
 import os
+import tempfile
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
 
-from app import create_app
-from models import setup_db, db_drop_and_create_all, create_test_data, Movie
+import auth.auth
+from auth.auth import AuthError
+from app import create_app, RESPONSE_CACHE_MAX_BYTES
+from auth.local import LocalIssuer
+from compression import brotli
+import importer
+from importer import run_import
+from json_provider import JSONProvider, OrjsonProvider, StdlibJSONProvider, get_json_provider, orjson
+from cache import LRUCache, SharedCache
+from models import db_drop_and_create_all, create_test_data, db, Movie, Actor, actor_movie, InstrumentedQueuePool, \
+    get_versions
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,38 +30,181 @@ user_name = os.environ.get('DB_USER')
 password = os.environ.get('DB_PASSWORD')
 
 
+def get_test_database_url():
+    """Returns the database of the tests: TEST_DATABASE_URL, else the
+    lav_cast_agency_TEST database of DB_USER on the local postgresql server,
+    else an in-memory SQLite database.
+    Under pytest-xdist every worker gets a database of its own, suffixed with
+    the worker id (i.e. lav_cast_agency_TEST_gw1)"""
+    url = os.environ.get('TEST_DATABASE_URL')
+    if url is None and user_name is not None:
+        url = "postgresql://" + user_name + ":" + (password or '') + "@{}/{}".format('localhost:5432',
+                                                                                    "lav_cast_agency_TEST")
+    if url is None:
+        return 'sqlite://'
+
+    url = make_url(url.replace('postgres://', 'postgresql://', 1))
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker and url.database not in (None, '', ':memory:'):
+        name, extension = os.path.splitext(url.database) if url.get_backend_name() == 'sqlite' else (url.database, '')
+        url = url.set(database=name + '_' + worker + extension)
+    return url.render_as_string(hide_password=False)
+
+
+TEST_DATABASE_URL = get_test_database_url()
+ON_POSTGRESQL = make_url(TEST_DATABASE_URL).get_backend_name() == 'postgresql'
+
+
+def create_database(url):
+    """Creates the postgresql database of url unless it exists"""
+    url = make_url(url)
+    engine = create_engine(url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        if not connection.exec_driver_sql('SELECT 1 FROM pg_database WHERE datname = %(name)s',
+                                          {'name': url.database}).scalar():
+            connection.exec_driver_sql('CREATE DATABASE "%s"' % url.database)
+    engine.dispose()
+
+
+def enable_sqlite_savepoints(engine):
+    """pysqlite begins transactions on its own, only before writes, and so
+    breaks SAVEPOINT: let SQLAlchemy emit BEGIN instead"""
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def emit_begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+def get_tokens():
+    """Returns the bearer token of each role: ASSISTANT, DIRECTOR and PRODUCER
+    of the environment, else tokens signed by a local stand-in for Auth0 that
+    auth.auth trusts until the end of the run"""
+    roles = ('assistant', 'director', 'producer')
+    if all(os.environ.get(role.upper()) for role in roles):
+        return {role: os.environ[role.upper()] for role in roles}
+
+    issuer = LocalIssuer('test.local', 'test_API', bits=1024)
+    for name, value in (('AUTH0_DOMAIN', 'test.local'), ('API_AUDIENCE', 'test_API'), ('ALGORITHMS', ['RS256']),
+                        ('jwks_cache', auth.auth.JWKSCache(fetcher=issuer.jwks))):
+        patcher = mock.patch.object(auth.auth, name, value)
+        patcher.start()
+        unittest.addModuleCleanup(patcher.stop)
+    return {role: issuer.token(role) for role in roles}
+
+
+test_app = None
+tokens = None
+METRICS_TOKEN = 'test-metrics-token'
+METRICS_HEADERS = {'Authorization': 'Bearer ' + METRICS_TOKEN}
+
+
+def setUpModule():
+    """Creates the app, the schema and the test data once per run (per
+    process); every test then runs in a transaction that is rolled back"""
+    global test_app, tokens
+    if ON_POSTGRESQL and os.environ.get('PYTEST_XDIST_WORKER'):
+        create_database(TEST_DATABASE_URL)
+
+    with mock.patch.dict(os.environ, {'DATABASE_URL': TEST_DATABASE_URL}):
+        test_app = create_app({'METRICS_TOKEN': METRICS_TOKEN})
+    with test_app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            enable_sqlite_savepoints(db.engine)
+        db_drop_and_create_all()
+        create_test_data()
+        db.session.remove()
+    tokens = get_tokens()
+
+
 class AgencyTestCase(unittest.TestCase):
     """This class represents the Casting Agency test case"""
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.casting_assistant = os.environ.get('ASSISTANT')
-        self.casting_director = os.environ.get('DIRECTOR')
-        self.executive_producer = os.environ.get('PRODUCER')
+        """Define test variables and open the transaction of the test."""
+        self.casting_assistant = tokens['assistant']
+        self.casting_director = tokens['director']
+        self.executive_producer = tokens['producer']
         self.new_actor = {'name': 'TestActor',
                           'age': 20,
                           'gender': 'Male'}
-        self.app = create_app()
+        self.app = test_app
         self.client = self.app.test_client
-        self.database_name = "lav_cast_agency_TEST"
-        # better: pass the db password as a secret/environment variable
-        self.database_path = "postgresql://" + user_name + ":" + password + "@{}/{}".format('localhost:5432',
-                                                                                            self.database_name)
-
-        setup_db(self.app, self.database_path)
+        # the cache of the previous test holds rows that were rolled back
+        self.app.config['RESPONSE_CACHE'] = LRUCache(RESPONSE_CACHE_MAX_BYTES) if RESPONSE_CACHE_MAX_BYTES else None
+        # other test cases create apps of their own
+        db.app = self.app
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-
-        # drop and create all tables for TEST db
-        db_drop_and_create_all()
-        create_test_data()
+        # the sessions of the test, committing or not, work in a SAVEPOINT of
+        # self.transaction, which tearDown rolls back
+        self.connection = db.get_engine(self.app).connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        self.session = db.create_scoped_session({'bind': self.connection, 'binds': {}})
+        event.listen(self.session, 'after_transaction_end', self.restart_savepoint)
+        self.original_session, db.session = db.session, self.session
 
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        self.session.remove()
+        db.session = self.original_session
+        self.transaction.rollback()
+        self.connection.close()
+
+    def restart_savepoint(self, session, transaction):
+        if not self.savepoint.is_active and self.transaction.is_active:
+            self.savepoint = self.connection.begin_nested()
+
+    def empty_tables(self):
+        """Deletes all movies, actors and casting links, until the end of the test"""
+        for table in (actor_movie, Movie.__table__, Actor.__table__):
+            db.session.execute(table.delete())
+        db.session.commit()
+
+    def count_statements(self, func):
+        """Runs func and returns its result and the SQL statements it executed,
+        leaving out the reads and bumps of the table_version counters, the
+        change_log entries and the savepoints of the test transaction"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not any(skipped in statement for skipped in ('table_version', 'change_log', 'SAVEPOINT')):
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return result, statements
+
+    def query_plan(self, path):
+        """GETs path and returns the query plan of the listing query it ran, as text.
+        On postgresql sequential scans are disabled while planning, so that the
+        few rows of the test tables still show whether an index can serve the query"""
+        executed = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if 'table_version' not in statement and 'SAVEPOINT' not in statement:
+                executed.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().get(path, headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(res.status_code, 200)
+
+        statement, parameters = executed[-1]
+        if db.engine.dialect.name == 'postgresql':
+            self.connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+            rows = self.connection.exec_driver_sql('EXPLAIN ' + statement, parameters).fetchall()
+            self.connection.exec_driver_sql('SET LOCAL enable_seqscan = on')
+        else:
+            rows = self.connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        return '\n'.join(str(row[-1]) for row in rows)
 
     """
     TODO
@@ -61,8 +221,43 @@ class AgencyTestCase(unittest.TestCase):
         self.assertTrue(data['movies'])
         self.assertTrue(len(data['movies']))
 
+    def test_SUCCESS_ASSISTANT_GET_movie(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant)}
+        res = self.client().get('/movies/1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['title'], 'TestDune')
+
+        res = self.client().get('/movies/1', headers=dict(headers, **{'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_SUCCESS_ASSISTANT_GET_movie_iso_dates_with_each_provider(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant)}
+        bodies = []
+        for provider in [StdlibJSONProvider()] + ([OrjsonProvider()] if orjson else []):
+            self.app.config['RESPONSE_CACHE'] = None
+            with mock.patch.object(self.app, 'json_provider', provider):
+                res = self.client().get('/movies/1', headers=headers)
+            bodies.append(res.data)
+
+        data = json.loads(bodies[0])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(data['movie']['release_date'], '1984-01-01T00:00:00')
+        self.assertEqual(len(set(bodies)), 1)
+
+    def test_ERROR_ASSISTANT_GET_movie_not_found(self):
+        res = self.client().get('/movies/3333', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_ERROR_ASSISTANT_GET_movies_empty_db(self):
-        db_drop_and_create_all()
+        self.empty_tables()
         res = self.client().get('/movies', headers={"Authorization": "Bearer {}".format(
                                     self.casting_assistant)
                                     })
@@ -71,6 +266,229 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    def test_SUCCESS_ASSISTANT_GET_movies_paginated(self):
+        for title in ['TestArrival', 'TestSicario']:
+            Movie(title=title, release_date='2016-1-1').insert()
+
+        res = self.client().get('/movies?limit=2', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 2)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get('/movies?limit=2&cursor={}'.format(data['next_cursor']),
+                                headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_ERROR_ASSISTANT_GET_movies_cursor_out_of_range(self):
+        res = self.client().get('/movies?cursor=100000000000000000000000', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_SUCCESS_ASSISTANT_GET_movies_one_projection_query(self):
+        # a cast used to be loaded along with every listed movie
+        movie = Movie.query.first()
+        movie.actors.append(Actor.query.first())
+        movie.update()
+
+        res, statements = self.count_statements(lambda: self.client().get(
+            '/movies', headers={"Authorization": "Bearer {}".format(self.casting_assistant)}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('actor', statements[0])
+        self.assertNotIn('release_date', statements[0])
+
+    def test_SUCCESS_ASSISTANT_GET_movies_include_actors(self):
+        movie = Movie.query.first()
+        movie.actors.append(Actor.query.first())
+        movie.update()
+
+        res, statements = self.count_statements(lambda: self.client().get(
+            '/movies?include=actors', headers={"Authorization": "Bearer {}".format(self.casting_assistant)}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'][0]['actors'][0]['name'], 'TestPaul')
+        # the page and one selectin load of the cast
+        self.assertEqual(len(statements), 2)
+
+    def test_SUCCESS_movie_lookup_does_not_load_cast(self):
+        movie, statements = self.count_statements(lambda: Movie.query.first())
+
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('actors', movie.__dict__)
+
+    def test_ERROR_ASSISTANT_GET_actors_unknown_include(self):
+        res = self.client().get('/actors?include=agents', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_SUCCESS_ASSISTANT_GET_actors_fields(self):
+        res = self.client().get('/actors?fields=name,age', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'name': 'TestPaul', 'age': 15}])
+
+    def test_ERROR_ASSISTANT_GET_actors_unknown_field(self):
+        res = self.client().get('/actors?fields=name,salary', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_SUCCESS_ASSISTANT_GET_movies_cached_until_write(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant)}
+        self.client().get('/movies', headers=headers)
+
+        res, statements = self.count_statements(lambda: self.client().get('/movies', headers=headers))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(statements, [])
+
+        Movie(title='TestArrival').insert()
+        res, statements = self.count_statements(lambda: self.client().get('/movies', headers=headers))
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 2)
+        self.assertEqual(len(statements), 1)
+
+    def test_SUCCESS_ASSISTANT_GET_movies_not_modified(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant)}
+        etag = self.client().get('/movies', headers=headers).headers['ETag']
+
+        res, statements = self.count_statements(lambda: self.client().get(
+            '/movies', headers=dict(headers, **{'If-None-Match': etag})))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(statements, [])
+
+        res = self.client().get('/movies?limit=1', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+
+        Movie(title='TestArrival').insert()
+        res = self.client().get('/movies', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_UNAUTH_ERROR_cached_movies_still_check_permissions(self):
+        self.client().get('/movies', headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+
+        res = self.client().get('/movies', headers={"Authorization": "Bearer invalid"})
+        self.assertNotEqual(res.status_code, 200)
+
+    def test_SUCCESS_ASSISTANT_GET_movies_search(self):
+        for title in ['Dune Messiah', 'Dune', 'Dunkirk', 'Arrival']:
+            Movie(title=title).insert()
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant)}
+
+        res = self.client().get('/movies?q=dune', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Dune', 'Dune Messiah'])
+
+        res = self.client().get('/movies?q=DUN&limit=2', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 2)
+        res = self.client().get('/movies?q=DUN&limit=2&cursor={}'.format(data['next_cursor']), headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertIsNone(data['next_cursor'])
+
+        res = self.client().get('/actors?q=testp', headers=headers)
+        self.assertEqual(json.loads(res.data)['actors'], [{'id': 1, 'name': 'TestPaul'}])
+
+    def test_ERROR_ASSISTANT_GET_movies_search_without_words(self):
+        res = self.client().get('/movies?q=%25%20', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_SUCCESS_ASSISTANT_GET_actors_filtered(self):
+        for name, age, gender in [('TestJessica', 40, 'female'), ('TestLeto', 45, 'male'), ('TestAlia', 4, 'female')]:
+            Actor(name=name, age=age, gender=gender).insert()
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant)}
+
+        res = self.client().get('/actors?gender=female&age_min=18', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(list(data['actors'].values()), ['TestJessica'])
+
+        res = self.client().get('/actors?age_min=10&age_max=45&limit=2', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(list(data['actors'].values()), ['TestPaul', 'TestJessica'])
+        res = self.client().get('/actors?age_min=10&age_max=45&limit=2&cursor={}'.format(data['next_cursor']),
+                                headers=headers)
+        self.assertEqual(list(json.loads(res.data)['actors'].values()), ['TestLeto'])
+
+    def test_SUCCESS_ASSISTANT_GET_movies_released_between(self):
+        Movie(title='TestArrival', release_date='2016-11-11').insert()
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant)}
+
+        res = self.client().get('/movies?released_after=2000-01-01', headers=headers)
+        self.assertEqual(list(json.loads(res.data)['movies'].values()), ['TestArrival'])
+        res = self.client().get('/movies?released_after=1984-01-01&released_before=1999-12-31', headers=headers)
+        self.assertEqual(list(json.loads(res.data)['movies'].values()), ['TestDune'])
+
+    def test_ERROR_ASSISTANT_GET_actors_bad_filter(self):
+        res = self.client().get('/actors?age_min=old', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_ERROR_ASSISTANT_GET_actors_filter_out_of_range(self):
+        res = self.client().get('/actors?age_min=999999999999999999999999', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_SUCCESS_filters_use_indexes(self):
+        for path, index in [('/actors?gender=male', 'ix_actor_gender_id'),
+                            ('/actors?age_min=10&age_max=20', 'ix_actor_age'),
+                            ('/movies?released_after=1980-01-01&released_before=1990-01-01', 'ix_movie_release_date')]:
+            plan = self.query_plan(path)
+            self.assertIn(index, plan, path)
+            self.assertNotIn('Seq Scan', plan, path)
+            self.assertNotRegex(plan, r'(?m)^SCAN (actor|movie)$', path)
+
+    def test_ERROR_ASSISTANT_GET_movies_bad_limit(self):
+        res = self.client().get('/movies?limit=0', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_SUCCESS_ASSISTANT_GET_actors(self):
         res = self.client().get('/actors', headers={"Authorization": "Bearer {}".format(
                                     self.casting_assistant)
@@ -81,8 +499,36 @@ class AgencyTestCase(unittest.TestCase):
         self.assertTrue(data['actors'])
         self.assertTrue(len(data['actors']))
 
+    def test_SUCCESS_ASSISTANT_GET_actors_server_timing(self):
+        res = self.client().get('/actors', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        timing = res.headers['Server-Timing']
+        metrics = self.client().get('/metrics', headers=METRICS_HEADERS).get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertRegex(timing, r'auth_header;dur=[0-9.]+')
+        self.assertRegex(timing, r'check_permissions;dur=[0-9.]+')
+        self.assertRegex(timing, r'sql;dur=[0-9.]+;desc="\d+ statements?"')
+        self.assertRegex(timing, r'serialize;dur=[0-9.]+')
+        self.assertRegex(timing, r'total;dur=[0-9.]+$')
+        self.assertRegex(metrics, r'request_phase_seconds_count\{phase="sql"\} [1-9]')
+        self.assertRegex(metrics, r'request_phase_seconds_bucket\{phase="serialize",le="\+Inf"\} [1-9]')
+        self.assertRegex(metrics, r'request_seconds_count\{endpoint="get_actors"\} [1-9]')
+        self.assertRegex(metrics, r'auth_token_cache_misses_total [1-9]')
+        self.assertRegex(metrics, r'response_cache_misses_total [1-9]')
+
+    def test_SUCCESS_server_timing_header_disabled(self):
+        with mock.patch.dict(self.app.config, {'SERVER_TIMING': False}):
+            res = self.client().get('/actors', headers={"Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                        })
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Server-Timing', res.headers)
+
     def test_ERROR_ASSISTANT_GET_actors_empty_db(self):
-        db_drop_and_create_all()
+        self.empty_tables()
         res = self.client().get('/actors', headers={"Authorization": "Bearer {}".format(
                                     self.casting_assistant)
                                     })
@@ -120,6 +566,56 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    def test_SUCCESS_PRODUCER_POST_movies_bulk(self):
+        movies = [{'title': 'TestArrival', 'release_date': '2016-11-11'},
+                  {'release_date': '2016-1-1'},
+                  {'title': 'TestSicario'},
+                  {'title': 'TestEnemy', 'release_date': 'not a date'}]
+
+        res, statements = self.count_statements(lambda: self.client().post(
+            '/movies/bulk', json=movies, headers={"Authorization": "Bearer {}".format(self.executive_producer)}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([('id' in result, 'error' in result) for result in data['results']],
+                         [(True, False), (False, True), (True, False), (False, True)])
+        self.assertEqual(Movie.query.get(data['results'][2]['id']).title, 'TestSicario')
+        if db.engine.dialect.full_returning:
+            self.assertEqual(len([s for s in statements if s.startswith('INSERT')]), 1)
+
+    def test_SUCCESS_PRODUCER_POST_actors_bulk_invalid_strings(self):
+        actors = [self.new_actor, {'name': 'T' * 256}, {'name': 42},
+                  dict(self.new_actor, gender='g' * 26), dict(self.new_actor, name='TestJessica')]
+        res = self.client().post('/actors/bulk', json=actors, headers=
+                                 {"Authorization": "Bearer {}".format(
+                                     self.executive_producer)
+                                  })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([result['index'] for result in data['results'] if 'error' in result], [1, 2, 3])
+        self.assertEqual(data['results'][1]['error'], 'name is longer than 255 characters')
+        self.assertTrue(Actor.exists(data['results'][4]['id']))
+
+    def test_ERROR_PRODUCER_POST_actors_bulk_too_large(self):
+        with mock.patch('app.MAX_BULK_SIZE', 2):
+            res = self.client().post('/actors/bulk', json=[self.new_actor] * 3, headers=
+                                     {"Authorization": "Bearer {}".format(
+                                         self.executive_producer)
+                                      })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(data['success'], False)
+
+    def test_UNAUTH_ERROR_DIRECTOR_POST_movies_bulk(self):
+        res = self.client().post('/movies/bulk', json=[{'title': 'TestDune'}], headers=
+                                 {"Authorization": "Bearer {}".format(
+                                     self.casting_director)
+                                  })
+        self.assertEqual(res.status_code, 403)
+
     def test_SUCCESS_DIRECTOR_POST_actor(self):
         res = self.client().post('/actors', json=self.new_actor, headers=
                                                  {"Authorization": "Bearer {}".format(
@@ -139,6 +635,16 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    def test_ERROR_DIRECTOR_POST_actor_age_not_a_number(self):
+        res = self.client().post('/actors', json={'name': 'TestPaul',
+                                                  'age': [1]}, headers=
+                                                 {"Authorization": "Bearer {}".format(
+                                                    self.casting_director)
+                                                  })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_SUCCESS_DIRECTOR_PATCH_movie(self):
         res = self.client().patch('/movies/1', json={'title': 'TestPatchDune',
                                                      'release_date': '2021-10-1'}, headers=
@@ -160,6 +666,56 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    def test_SUCCESS_DIRECTOR_PATCH_movie_single_statement(self):
+        res, statements = self.count_statements(lambda: self.client().patch(
+            '/movies/1', json={'title': 'TestPatchDune'},
+            headers={"Authorization": "Bearer {}".format(self.casting_director)}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'][0]['title'], 'TestPatchDune')
+        self.assertTrue(statements[0].startswith('UPDATE'))
+        if db.engine.dialect.full_returning:
+            self.assertEqual(len(statements), 1)
+            self.assertIn('RETURNING', statements[0])
+        else:
+            # without RETURNING the row is read back by the next statement
+            self.assertEqual(len(statements), 2)
+
+    def test_ERROR_DIRECTOR_PATCH_movie_bad_date(self):
+        res = self.client().patch('/movies/1', json={'release_date': 'not a date'}, headers=
+                                  {"Authorization": "Bearer {}".format(self.casting_director)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_ERROR_DIRECTOR_PATCH_movie_null_title(self):
+        res = self.client().patch('/movies/1', json={'title': None}, headers=
+                                  {"Authorization": "Bearer {}".format(self.casting_director)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(Movie.query.get(1).title, 'TestDune')
+
+    def test_ERROR_PRODUCER_PATCH_actor_gender_too_long(self):
+        res = self.client().patch('/actors/1', json={'gender': 'x' * 26}, headers=
+                                  {"Authorization": "Bearer {}".format(self.executive_producer)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_ERROR_DIRECTOR_PATCH_missing_movie(self):
+        res = self.client().patch('/movies/3333', json={'title': 'TestPatchDune'}, headers=
+                                  {"Authorization": "Bearer {}".format(
+                                      self.casting_director)
+                                   })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_SUCCESS_PRODUCER_PATCH_actor(self):
         res = self.client().patch('/actors/1', json={'name': 'NewName',
                                                      'age': '25',
@@ -191,6 +747,21 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_SUCCESS_PRODUCER_DELETE_cast_movie(self):
+        actor = Actor(name='TestJessica', age=40, gender='Female')
+        actor.insert()
+        actor_id = actor.id
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        self.client().post('/movies/1/actors', json={'actors': [actor_id]}, headers=headers)
+
+        res, statements = self.count_statements(lambda: self.client().delete('/movies/1', headers=headers))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('DELETE'))
+
+        res = self.client().get('/actors/{}/movies'.format(actor_id), headers=headers)
+        self.assertEqual(json.loads(res.data)['movies'], {})
+
     def test_UNAUTH_ERROR_DIRECTOR_DELETE_movie(self):
         res = self.client().delete('/movies/1', headers=
                                                  {"Authorization": "Bearer {}".format(
@@ -227,6 +798,365 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    def test_SUCCESS_DIRECTOR_cast_and_uncast_actors(self):
+        actor_ids = [Actor.query.first().id]
+        for name in ['TestJessica', 'TestLeto']:
+            actor = Actor(name=name, age=40, gender='Female')
+            actor.insert()
+            actor_ids.append(actor.id)
+        headers = {"Authorization": "Bearer {}".format(self.casting_director)}
+
+        res, statements = self.count_statements(lambda: self.client().post(
+            '/movies/1/actors', json={'actors': actor_ids}, headers=headers))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['added'], 3)
+        self.assertEqual(len(statements), 1)
+
+        res = self.client().post('/movies/1/actors', json={'actors': actor_ids}, headers=headers)
+        self.assertEqual(json.loads(res.data)['added'], 0)
+
+        res = self.client().get('/movies/1/actors?limit=2', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 2)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get('/actors/{}/movies'.format(actor_ids[0]), headers=headers)
+        self.assertEqual(json.loads(res.data)['movies'], {'1': 'TestDune'})
+
+        res = self.client().delete('/movies/1/actors', json={'actors': actor_ids[:2]}, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['removed'], 2)
+        self.assertEqual(len(Movie.query.get(1).actors), 1)
+
+    def test_ERROR_DIRECTOR_cast_actors_unknown_movie(self):
+        res = self.client().post('/movies/3333/actors', json={'actors': [1]}, headers=
+                                                 {"Authorization": "Bearer {}".format(
+                                                    self.casting_director)
+                                                  })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_ERROR_DIRECTOR_cast_unknown_actor(self):
+        res = self.client().post('/movies/1/actors', json={'actors': [3333]}, headers=
+                                                 {"Authorization": "Bearer {}".format(
+                                                    self.casting_director)
+                                                  })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_ERROR_DIRECTOR_cast_actors_not_a_list(self):
+        res = self.client().post('/movies/1/actors', json={'actors': 'TestPaul'}, headers=
+                                                 {"Authorization": "Bearer {}".format(
+                                                    self.casting_director)
+                                                  })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_ERROR_DIRECTOR_cast_actors_id_out_of_range(self):
+        res = self.client().post('/movies/1/actors', json={'actors': [2 ** 40]}, headers=
+                                                 {"Authorization": "Bearer {}".format(
+                                                    self.casting_director)
+                                                  })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_SUCCESS_DIRECTOR_recast_keeps_cast_version(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_director)}
+        movie_id, actor_id = Movie.query.first().id, Actor.query.first().id
+        self.client().post('/movies/%d/actors' % movie_id, json={'actors': [actor_id]}, headers=headers)
+        version = get_versions([actor_movie.name])
+
+        added = self.client().post('/movies/%d/actors' % movie_id, json={'actors': [actor_id]}, headers=headers)
+        removed = self.client().delete('/movies/%d/actors' % movie_id, json={'actors': [3333]}, headers=headers)
+
+        self.assertEqual(json.loads(added.data)['added'], 0)
+        self.assertEqual(json.loads(removed.data)['removed'], 0)
+        self.assertEqual(get_versions([actor_movie.name]), version)
+
+    def test_UNAUTH_ERROR_ASSISTANT_cast_actors(self):
+        res = self.client().post('/movies/1/actors', json={'actors': [1]}, headers=
+                                                 {"Authorization": "Bearer {}".format(
+                                                    self.casting_assistant)
+                                                  })
+        self.assertEqual(res.status_code, 403)
+
+    def test_SUCCESS_ASSISTANT_GET_export(self):
+        movie = Movie.query.first()
+        movie.actors.append(Actor.query.first())
+        movie.update()
+        movie_id = movie.id
+
+        res = self.client().get('/export', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        lines = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([line['type'] for line in lines], ['movie', 'actor', 'cast'])
+        self.assertEqual(lines[0]['title'], 'TestDune')
+        self.assertEqual(lines[2]['movie_id'], movie_id)
+
+    def test_SUCCESS_ASSISTANT_GET_export_gzip_streamed(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant), 'Accept-Encoding': 'gzip'}
+        with mock.patch('app.EXPORT_BATCH_SIZE', 1):
+            res = self.client().get('/export', headers=headers, buffered=False)
+            decompressor = zlib.decompressobj(31)
+            # every chunk decompresses to whole lines as soon as it arrives
+            chunks = [decompressor.decompress(chunk) for chunk in res.response]
+            res.close()
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        lines = [chunk for chunk in chunks if chunk]
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(all(line.endswith(b'\n') for line in lines))
+        self.assertEqual(json.loads(lines[0])['type'], 'movie')
+        self.assertTrue(decompressor.eof)
+
+    def test_SUCCESS_ASSISTANT_GET_actors_gzip(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant), 'Accept-Encoding': 'br;q=0, gzip'}
+        with mock.patch.dict(self.app.config, {'COMPRESS_MIN_SIZE': 0, 'COMPRESS_ENCODINGS': 'gzip'}):
+            res = self.client().get('/actors', headers=headers)
+            etag = res.headers['ETag']
+            not_modified = self.client().get('/actors', headers=dict(headers, **{'If-None-Match': etag}))
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertTrue(data['actors'])
+        self.assertRegex(etag, r'^"[0-9a-f]+-gzip"$')
+        self.assertRegex(res.headers['Server-Timing'], r'compress;dur=[0-9.]+')
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.headers['ETag'], etag)
+        self.assertIn('Accept-Encoding', not_modified.headers['Vary'])
+
+    def test_SUCCESS_ASSISTANT_GET_actors_gzip_etag_needs_gzip(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant), 'Accept-Encoding': 'gzip'}
+        with mock.patch.dict(self.app.config, {'COMPRESS_MIN_SIZE': 0, 'COMPRESS_ENCODINGS': 'gzip'}):
+            etag = self.client().get('/actors', headers=headers).headers['ETag']
+            # the held body is gzip, which this client no longer accepts
+            res = self.client().get('/actors', headers=dict(headers, **{'Accept-Encoding': 'identity',
+                                                                       'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertTrue(json.loads(res.data)['actors'])
+
+    def test_ERROR_ASSISTANT_GET_movie_if_none_match_star(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant), 'If-None-Match': '*'}
+        found = self.client().get('/movies/1', headers=headers)
+        missing = self.client().get('/movies/1000', headers=headers)
+
+        self.assertEqual(found.status_code, 304)
+        self.assertEqual(missing.status_code, 404)
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_SUCCESS_ASSISTANT_GET_export_brotli_streamed(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant), 'Accept-Encoding': 'gzip, br'}
+        res = self.client().get('/export', headers=headers)
+        lines = brotli.decompress(res.data).decode().splitlines()
+
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(lines[0])['title'], 'TestDune')
+
+    def test_SUCCESS_ASSISTANT_GET_actors_not_compressed(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_assistant)}
+        # below the threshold, and not accepted
+        small = self.client().get('/actors', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+        with mock.patch.dict(self.app.config, {'COMPRESS_MIN_SIZE': 0}):
+            refused = self.client().get('/actors', headers=dict(headers, **{'Accept-Encoding': 'gzip;q=0'}))
+
+        for res in (small, refused):
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn('Content-Encoding', res.headers)
+            self.assertIn('Accept-Encoding', res.headers['Vary'])
+            self.assertTrue(json.loads(res.data)['actors'])
+
+    def test_SUCCESS_ASSISTANT_GET_export_id_range(self):
+        res = self.client().get('/export?min_id=2', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, b'')
+
+    def test_SUCCESS_ASSISTANT_GET_export_updated_since(self):
+        for table in (Movie.__table__, Actor.__table__):
+            db.session.execute(table.update().values(created_at=datetime.datetime(2000, 1, 1),
+                                                     updated_at=datetime.datetime(2000, 1, 1)))
+        db.session.commit()
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        self.client().post('/movies', json={'title': 'TestArrival'}, headers=headers)
+        movie_id = Movie.query.filter(Movie.title == 'TestArrival').one().id
+        actor_id = Actor.query.first().id
+        self.client().post('/movies/%d/actors' % movie_id, json={'actors': [actor_id]}, headers=headers)
+
+        res = self.client().get('/export?updated_since=2020-01-01T00:00:00%2B00:00', headers={
+                                    "Authorization": "Bearer {}".format(self.casting_assistant)
+                                    })
+        lines = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(line['type'], line.get('id', line.get('movie_id'))) for line in lines],
+                         [('movie', movie_id), ('cast', movie_id)])
+
+    def test_ERROR_ASSISTANT_GET_export_bad_updated_since(self):
+        res = self.client().get('/export?updated_since=yesterday', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_ERROR_ASSISTANT_GET_export_bad_range(self):
+        res = self.client().get('/export?max_id=last', headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+
+        self.assertEqual(res.status_code, 400)
+
+    def get_changes(self, query=''):
+        res = self.client().get('/changes' + query, headers={"Authorization": "Bearer {}".format(
+                                    self.casting_assistant)
+                                    })
+        return res, json.loads(res.data)
+
+    def test_SUCCESS_ASSISTANT_GET_changes(self):
+        _, data = self.get_changes()
+        since = data['next_since']
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        actor_id = Actor.query.first().id
+        self.client().post('/movies', json={'title': 'TestArrival'}, headers=headers)
+        movie_id = Movie.query.filter(Movie.title == 'TestArrival').one().id
+        self.client().patch('/actors/%d' % actor_id, json={'age': 16}, headers=headers)
+        self.client().post('/movies/%d/actors' % movie_id, json={'actors': [actor_id]}, headers=headers)
+
+        res, data = self.get_changes('?since=%d' % since)
+        changes = {(change['type'], change['operation']): change for change in data['changes']}
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(changes), {('movie', 'insert'), ('actor', 'update'), ('cast', 'update')})
+        self.assertEqual(changes[('movie', 'insert')]['data']['title'], 'TestArrival')
+        self.assertEqual(changes[('actor', 'update')]['data']['age'], 16)
+        self.assertGreaterEqual(changes[('actor', 'update')]['data']['updated_at'],
+                                changes[('actor', 'update')]['data']['created_at'])
+        self.assertEqual(changes[('cast', 'update')]['id'], movie_id)
+        self.assertEqual(changes[('cast', 'update')]['data'], {'actors': [actor_id]})
+        self.assertEqual(data['next_since'], data['changes'][-1]['cursor'])
+        self.assertFalse(data['has_more'])
+
+        since = data['next_since']
+        self.client().delete('/movies/%d' % movie_id, headers=headers)
+        _, data = self.get_changes('?since=%d' % since)
+
+        self.assertEqual([(change['type'], change['id'], change['operation'], change['data'])
+                          for change in data['changes']], [('movie', movie_id, 'delete', None)])
+
+    def test_SUCCESS_ASSISTANT_GET_changes_paginated(self):
+        _, data = self.get_changes()
+        since = data['next_since']
+        movie = Movie.query.first()
+        movie.title = 'TestDuneUpdated'
+        movie.update()
+        movie.title = 'TestDuneRenamed'
+        movie.update()
+        Actor(name='TestJessica').insert()
+
+        _, first = self.get_changes('?since=%d&limit=2' % since)
+        _, second = self.get_changes('?since=%d&limit=2' % first['next_since'])
+        query = '?since=%d&limit=2' % second['next_since']
+        res, caught_up = self.get_changes(query)
+        # nothing changed since: polling again costs a 304
+        not_modified = self.client().get('/changes' + query, headers={
+                                             "Authorization": "Bearer {}".format(self.casting_assistant),
+                                             'If-None-Match': res.headers['ETag']})
+
+        # the two updates of the movie are one change, with its latest title
+        self.assertEqual([change['data']['title'] for change in first['changes']], ['TestDuneRenamed'])
+        self.assertTrue(first['has_more'])
+        self.assertEqual([change['type'] for change in second['changes']], ['actor'])
+        self.assertFalse(second['has_more'])
+        self.assertEqual(caught_up['changes'], [])
+        self.assertEqual(caught_up['next_since'], second['next_since'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_ERROR_ASSISTANT_GET_changes_bad_since(self):
+        res, data = self.get_changes('?since=-1')
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_SUCCESS_import_and_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {
+                'movies': ('movies.ndjson', '{"id": 10, "title": "TestArrival"}\n{"id": 11}\n'
+                                            '{"id": 12, "title": "TestSicario", "release_date": "2015-9-18"}\n'),
+                'actors': ('actors.csv', 'id,name,age,gender\n20,TestAmy,40,Female\n21,TestEmily,32,\n'),
+                'cast': ('cast.ndjson', '{"movie_id": 10, "actor_id": 20}\n{"movie_id": 12, "actor_id": 21}\n'
+                                        '{"movie_id": 99, "actor_id": 21}\n')
+            }
+            paths = {}
+            for kind, (name, content) in files.items():
+                paths[kind] = os.path.join(tmp, name)
+                with open(paths[kind], 'w') as f:
+                    f.write(content)
+
+            run_import(chunk_size=2, name='test', **paths)
+            # running again with the same name resumes after the last chunk
+            run_import(chunk_size=2, name='test', **paths)
+
+        self.assertEqual(Movie.query.count(), 3)
+        self.assertEqual(Actor.query.count(), 3)
+        sicario = Movie.query.filter(Movie.title == 'TestSicario').one()
+        self.assertEqual([actor.name for actor in sicario.actors], ['TestEmily'])
+
+    def test_SUCCESS_import_resume_after_crash(self):
+        insert_rows = importer.insert_rows
+        calls = []
+
+        def crash_after_second_chunk(model, rows):
+            ids = insert_rows(model, rows)
+            calls.append(model)
+            if len(calls) == 2:
+                raise RuntimeError('crash')
+            return ids
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'movies.ndjson')
+            with open(path, 'w') as f:
+                f.write(''.join('{"id": %d, "title": "TestMovie%d"}\n' % (i, i) for i in range(5)))
+
+            with mock.patch('importer.insert_rows', side_effect=crash_after_second_chunk):
+                with self.assertRaises(RuntimeError):
+                    run_import(movies=path, chunk_size=2, name='test')
+            db.session.rollback()
+            run_import(movies=path, chunk_size=2, name='test')
+
+        titles = [title for title, in db.session.query(Movie.title).filter(Movie.title.like('TestMovie%'))]
+        self.assertEqual(sorted(titles), ['TestMovie%d' % i for i in range(5)])
+        self.assertEqual(len(importer.ImportState('test').section('movie')['ids']), 5)
+
+    def test_ERROR_ASSISTANT_GET_movies_jwks_unavailable(self):
+        error = AuthError({'code': 'jwks_unavailable', 'description': 'Unable to fetch the signing keys.'}, 503)
+        with mock.patch('auth.auth.get_verified_payload', side_effect=error):
+            res = self.client().get('/movies', headers={"Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                        })
+
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(data['message'], 'Service Unavailable')
+
     def test_UNAUTH_ERROR_ASSISTANT_POST_actor(self):
         res = self.client().post('/actors',
                                  headers={"Authorization": "Bearer {}".format(
@@ -238,5 +1168,160 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'Permission not found')
 
 
+@unittest.skipUnless(ON_POSTGRESQL, 'pool and statement timeout settings need postgresql')
+class DatabaseSettingsTestCase(unittest.TestCase):
+    """This class represents the connection pool and statement timeout settings test case"""
+
+    def create_configured_app(self, config):
+        """Returns an app on the test database with the given DB_* settings"""
+        with mock.patch.dict(os.environ, {'DATABASE_URL': TEST_DATABASE_URL}):
+            app = create_app(dict(config, METRICS_TOKEN=METRICS_TOKEN))
+        # the session of this thread is still bound to the app of the previous test
+        db.session.remove()
+        self.addCleanup(lambda: db.get_engine(app).dispose())
+        self.addCleanup(db.session.remove)
+        return app
+
+    def test_SUCCESS_pool_configured_from_config(self):
+        app = self.create_configured_app({'DB_POOL_SIZE': 2, 'DB_MAX_OVERFLOW': 1, 'DB_POOL_TIMEOUT': 0.1})
+
+        with app.app_context():
+            pool = db.engine.pool
+            self.assertIsInstance(pool, InstrumentedQueuePool)
+            self.assertEqual(pool.size(), 2)
+            self.assertTrue(db.engine.pool._pre_ping)
+
+            connections = [db.engine.connect() for _ in range(3)]
+            self.assertEqual(pool.overflow(), 1)
+            metrics = app.test_client().get('/metrics', headers=METRICS_HEADERS).get_data(as_text=True)
+            with self.assertRaises(PoolTimeoutError):
+                db.engine.connect()
+            for connection in connections:
+                connection.close()
+
+        self.assertIn('db_pool_checked_out 3', metrics)
+        self.assertIn('db_pool_overflow 1', metrics)
+        self.assertIn('db_pool_checkout_seconds_count', metrics)
+        self.assertIn('db_pool_checkout_timeouts_total',
+                      app.test_client().get('/metrics', headers=METRICS_HEADERS).get_data(as_text=True))
+
+    def test_ERROR_statement_timeout(self):
+        app = self.create_configured_app({'DB_STATEMENT_TIMEOUT': 50})
+
+        with app.app_context():
+            with self.assertRaises(OperationalError):
+                db.session.execute('SELECT pg_sleep(1)')
+            db.session.rollback()
+
+    def test_SUCCESS_pgbouncer_mode_sets_timeout_per_transaction(self):
+        app = self.create_configured_app({'DB_STATEMENT_TIMEOUT': 50, 'DB_PGBOUNCER': True})
+
+        with app.app_context():
+            self.assertEqual(db.session.execute('SHOW statement_timeout').scalar(), '50ms')
+            db.session.commit()
+            self.assertEqual(db.session.execute('SHOW statement_timeout').scalar(), '50ms')
+            with db.engine.connect() as connection:
+                # outside a transaction the server default applies again
+                self.assertEqual(connection.exec_driver_sql('SHOW statement_timeout').scalar(), '0')
+            db.session.rollback()
+
+
+class AppFactoryTestCase(unittest.TestCase):
+    """This class represents the app factory test case"""
+
+    def test_SUCCESS_create_app_does_not_connect(self):
+        # nothing listens there: any connection attempt would fail
+        with mock.patch.dict(os.environ, {'DATABASE_URL': 'postgresql://nobody@127.0.0.1:1/unreachable'}), \
+                mock.patch.object(SQLAlchemy, 'create_all') as create_all:
+            app = create_app({'METRICS_TOKEN': METRICS_TOKEN})
+            res = app.test_client().get('/metrics', headers=METRICS_HEADERS)
+
+        self.assertEqual(res.status_code, 200)
+        create_all.assert_not_called()
+
+    def test_ERROR_metrics_need_the_metrics_token(self):
+        with mock.patch.dict(os.environ, {'DATABASE_URL': 'sqlite://'}):
+            disabled = create_app()
+            app = create_app({'METRICS_TOKEN': METRICS_TOKEN})
+
+        self.assertEqual(disabled.test_client().get('/metrics', headers=METRICS_HEADERS).status_code, 404)
+        self.assertEqual(app.test_client().get('/metrics').status_code, 401)
+        res = app.test_client().get('/metrics', headers={'Authorization': 'Bearer ' + tokens['assistant']})
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(json.loads(res.data)['message'], 'unauthorized')
+
+
+class JSONProviderTestCase(unittest.TestCase):
+    """This class represents the JSON providers test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        with create_engine('sqlite://').connect() as connection:
+            row = connection.exec_driver_sql("SELECT 3 AS id, 'Heat' AS title").first()
+        cls.document = {'movies': {1: 'Amélie', 2: 'Dune'},
+                        'released': [datetime.datetime(1985, 12, 14), datetime.date(2021, 10, 22)],
+                        'row': row}
+
+    def test_SUCCESS_stdlib_provider(self):
+        self.assertEqual(json.loads(StdlibJSONProvider().dumps(self.document)), {
+            'movies': {'1': 'Amélie', '2': 'Dune'},
+            'released': ['1985-12-14T00:00:00', '2021-10-22'],
+            'row': {'id': 3, 'title': 'Heat'}
+        })
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_SUCCESS_orjson_provider_matches_stdlib(self):
+        self.assertEqual(OrjsonProvider().dumps(self.document), StdlibJSONProvider().dumps(self.document))
+
+    def test_ERROR_unknown_type(self):
+        with self.assertRaises(TypeError):
+            StdlibJSONProvider().dumps({'value': object()})
+
+    def test_SUCCESS_get_json_provider(self):
+        class UpperProvider(JSONProvider):
+            def dumps(self, obj):
+                return json.dumps(obj).upper().encode()
+
+        provider = UpperProvider()
+        self.assertIsInstance(get_json_provider('stdlib'), StdlibJSONProvider)
+        self.assertIs(get_json_provider(provider), provider)
+        with self.assertRaises(ValueError):
+            get_json_provider('simplejson')
+
+
+class ResponseCacheBackendTestCase(unittest.TestCase):
+    """This class represents the response cache backends test case"""
+
+    def test_SUCCESS_lru_evicts_by_size(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set('a', b'12345')
+        cache.set('b', b'12345')
+        cache.get('a')
+        cache.set('c', b'123')
+
+        self.assertEqual(cache.get('a'), b'12345')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['bytes'], 8)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ERROR_lru_skips_values_larger_than_cache(self):
+        cache = LRUCache(max_bytes=4)
+        cache.set('a', b'12345')
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_SUCCESS_shared_cache_over_stand_in_client(self):
+        class DictClient(dict):
+            def set(self, key, value, ex=None):
+                self[key] = value
+
+        client = DictClient()
+        cache = SharedCache(client, ttl=60)
+        cache.set('/movies?|1', b'{}')
+
+        self.assertEqual(cache.get('/movies?|1'), b'{}')
+        self.assertIn('lav_cast_agency:/movies?|1', client)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,253 @@
+import unittest
+import threading
+import time
+from unittest import mock
+
+from flask import Flask
+
+import auth.auth
+from auth.auth import AuthError, JWKSCache, TokenCache, check_permissions, requires_auth, \
+    fetch_jwks, verify_decode_jwt
+from auth.local import LocalIssuer, serve_jwks
+
+
+def make_jwks(*kids):
+    return {'keys': [{'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n-' + kid, 'e': 'AQAB'}
+                     for kid in kids]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingFetcher:
+    """Stand-in for the Auth0 JWKS endpoint"""
+
+    def __init__(self, *kids):
+        self.jwks = make_jwks(*kids)
+        self.calls = 0
+        self.fail = False
+        self.delay = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail:
+            raise OSError('JWKS endpoint unreachable')
+        return self.jwks
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS key cache test case"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.fetcher = CountingFetcher('key1')
+        self.cache = JWKSCache(fetcher=self.fetcher, ttl=600,
+                               min_refresh_interval=30, clock=self.clock)
+
+    def test_SUCCESS_keys_are_fetched_once(self):
+        for _ in range(10):
+            key = self.cache.get_key('key1')
+
+        self.assertEqual(key['n'], 'n-key1')
+        self.assertEqual(self.fetcher.calls, 1)
+
+    def test_SUCCESS_unknown_kid_forces_refresh(self):
+        self.cache.get_key('key1')
+        self.fetcher.jwks = make_jwks('key1', 'key2')
+        self.clock.now += 31
+
+        key = self.cache.get_key('key2')
+
+        self.assertEqual(key['kid'], 'key2')
+        self.assertEqual(self.fetcher.calls, 2)
+
+    def test_ERROR_unknown_kid_refresh_is_rate_limited(self):
+        self.cache.get_key('key1')
+        for _ in range(10):
+            self.assertIsNone(self.cache.get_key('bogus'))
+
+        self.assertEqual(self.fetcher.calls, 1)
+
+    def test_SUCCESS_stale_keys_served_when_fetch_fails(self):
+        self.cache.get_key('key1')
+        self.fetcher.fail = True
+        self.clock.now += 601
+
+        self.cache.refresh()
+        key = self.cache.get_key('key1')
+
+        self.assertEqual(key['kid'], 'key1')
+        self.assertEqual(self.fetcher.calls, 2)
+
+    def test_ERROR_no_keys_and_fetch_fails(self):
+        self.fetcher.fail = True
+
+        with self.assertRaises(AuthError) as ctx:
+            self.cache.get_key('key1')
+        self.assertEqual(ctx.exception.status_code, 503)
+
+    def test_SUCCESS_concurrent_cold_start_fetches_once(self):
+        self.fetcher.delay = 0.05
+        cache = JWKSCache(fetcher=self.fetcher)
+        results = []
+
+        def worker():
+            results.append(cache.get_key('key1'))
+
+        threads = [threading.Thread(target=worker) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fetcher.calls, 1)
+        self.assertTrue(all(result['kid'] == 'key1' for result in results))
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified-token cache test case"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TokenCache(maxsize=2, clock=self.clock)
+        self.payload = {'exp': self.clock.now + 60, 'permissions': ['view:movies']}
+
+    def test_SUCCESS_hit_after_put(self):
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.put('token', self.payload, frozenset(self.payload['permissions']))
+
+        payload, permissions = self.cache.get('token')
+        self.assertIs(payload, self.payload)
+        self.assertEqual(permissions, frozenset(['view:movies']))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_ERROR_expired_entry_is_a_miss(self):
+        self.cache.put('token', self.payload)
+        self.clock.now += 61
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_SUCCESS_least_recently_used_is_evicted(self):
+        self.cache.put('a', self.payload)
+        self.cache.put('b', self.payload)
+        self.cache.get('a')
+        self.cache.put('c', self.payload)
+
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_ERROR_token_without_exp_not_cached(self):
+        self.cache.put('token', {'permissions': []})
+
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_SUCCESS_requires_auth_verifies_token_once(self):
+        app = Flask(__name__)
+
+        @app.route('/')
+        @requires_auth('view:movies')
+        def index(jwt):
+            return 'ok'
+
+        payload = {'exp': time.time() + 60, 'permissions': ['view:movies']}
+        with mock.patch.object(auth.auth, 'token_cache', TokenCache()), \
+                mock.patch.object(auth.auth, 'verify_decode_jwt', return_value=payload) as verify:
+            for _ in range(5):
+                res = app.test_client().get('/', headers={'Authorization': 'Bearer abc'})
+                self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(verify.call_count, 1)
+
+
+class CheckPermissionsTestCase(unittest.TestCase):
+    """This class represents the permission check test case"""
+
+    def setUp(self):
+        self.payload = {'permissions': ['view:movies', 'view:actors', 'add:actors']}
+
+    def test_SUCCESS_single_permission(self):
+        self.assertTrue(check_permissions('view:movies', self.payload))
+
+    def test_ERROR_missing_permission(self):
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('delete:movies', self.payload)
+        self.assertEqual(ctx.exception.status_code, 403)
+
+    def test_ERROR_missing_permissions_claim(self):
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('view:movies', {})
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    def test_SUCCESS_all_of_and_any_of(self):
+        self.assertTrue(check_permissions(['view:movies', 'view:actors'], self.payload,
+                                          any_of=frozenset(['add:movies', 'add:actors'])))
+
+    def test_ERROR_none_of_any_of(self):
+        with self.assertRaises(AuthError):
+            check_permissions('view:movies', self.payload,
+                              any_of=frozenset(['add:movies', 'delete:movies']))
+
+    def test_ERROR_requires_auth_all_of(self):
+        app = Flask(__name__)
+
+        @app.route('/')
+        @requires_auth(['view:movies', 'delete:movies'])
+        def index(jwt):
+            return 'ok'
+
+        payload = dict(self.payload, exp=time.time() + 60)
+        with mock.patch.object(auth.auth, 'token_cache', TokenCache()), \
+                mock.patch.object(auth.auth, 'verify_decode_jwt', return_value=payload):
+            res = app.test_client().get('/', headers={'Authorization': 'Bearer abc'})
+
+        self.assertEqual(res.status_code, 403)
+
+
+class LocalIssuerTestCase(unittest.TestCase):
+    """This class represents the local stand-in for Auth0 test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.issuer = LocalIssuer('test.local', 'test_API', bits=1024)
+
+    def setUp(self):
+        for name, value in (('AUTH0_DOMAIN', 'test.local'), ('API_AUDIENCE', 'test_API'), ('ALGORITHMS', ['RS256']),
+                            ('jwks_cache', JWKSCache(fetcher=self.issuer.jwks))):
+            patcher = mock.patch.object(auth.auth, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_SUCCESS_minted_token_verifies(self):
+        payload = verify_decode_jwt(self.issuer.token('director'))
+
+        self.assertIn('modify:movies', payload['permissions'])
+        self.assertEqual(payload['iss'], 'https://test.local/')
+
+    def test_ERROR_expired_minted_token(self):
+        with self.assertRaises(AuthError) as ctx:
+            verify_decode_jwt(self.issuer.token('assistant', expires_in=-60))
+        self.assertEqual(ctx.exception.status_code, 401)
+
+    def test_SUCCESS_jwks_served_over_http(self):
+        server = serve_jwks(self.issuer)
+        self.addCleanup(server.shutdown)
+
+        with mock.patch.object(auth.auth, 'JWKS_URL', server.url):
+            jwks = fetch_jwks()
+
+        self.assertEqual(jwks, self.issuer.jwks())
+        self.assertEqual(server.fetches, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()